@@ -1,19 +1,316 @@
+import errno
+import mmap
+import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
+from diskcache import Cache as dc
 
 from sitefab.plugins import SitePreparsing
 from sitefab.SiteFab import SiteFab
+from sitefab.utils import hexdigest
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
 PROGBAR = None
+FICLONE = 0x40049409  # linux ioctl to reflink a file
+COPY_MODES = ['copy', 'hardlink', 'reflink']
+COPY_CHUNK_SIZE = 64  # files copied per task to amortize the dispatch
+
+# kernel features found to be unsupported by the filesystem being copied.
+# They are not retried for every file of the target.
+UNSUPPORTED = set()
+UNSUPPORTED_ERRNOS = [errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                      errno.EOPNOTSUPP, errno.EPERM, errno.EMLINK]
+
+
+def parse_target(target):
+    """Parse a target: "src > dst" or "src > dst | mode".
+
+    Returns:
+        (str, str, str): source, destination and copy mode or None if the
+        target is not properly formated.
+    """
+    if '>' not in target:
+        return None
+    mode = 'copy'
+    if '|' in target:
+        target, mode = target.split('|')
+        mode = mode.strip()
+    src, dst = target.split('>')
+    if mode not in COPY_MODES:
+        return None
+    return src.strip(), dst.strip(), mode
+
+
+def copy_file_data(src, dst):
+    """Copy the content of src into the new file dst within the kernel.
+
+    copy_file_range lets the filesystem share or offload the data, then
+    sendfile avoids the user space buffers, and a regular copy is used when
+    none of them is supported.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+        size = os.fstat(infd).st_size
+        copied = 0
+        if (hasattr(os, 'copy_file_range')
+                and 'copy_file_range' not in UNSUPPORTED):
+            try:
+                while copied < size:
+                    num_bytes = os.copy_file_range(infd, outfd, size - copied)
+                    if not num_bytes:
+                        break
+                    copied += num_bytes
+            except OSError as e:
+                if e.errno in UNSUPPORTED_ERRNOS:
+                    UNSUPPORTED.add('copy_file_range')
+        if (copied < size and hasattr(os, 'sendfile')
+                and 'sendfile' not in UNSUPPORTED):
+            try:
+                os.lseek(outfd, copied, os.SEEK_SET)
+                while copied < size:
+                    num_bytes = os.sendfile(outfd, infd, copied, size - copied)
+                    if not num_bytes:
+                        break
+                    copied += num_bytes
+            except OSError as e:
+                if e.errno in UNSUPPORTED_ERRNOS:
+                    UNSUPPORTED.add('sendfile')
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst)
+
+
+def reflink(src, dst):
+    "Copy-on-write clone of src into dst. Raise OSError if not supported"
+    if not fcntl:
+        raise OSError("reflink not supported")
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def materialize(src, dst, mode, replace=True):
+    """Make dst a copy of src.
+
+    Args:
+        src (str): file to copy.
+        dst (str): destination path.
+        mode (str): hardlink, reflink or copy. hardlink falls back to
+        reflink which falls back to copy when the filesystem does not support
+        them.
+        replace (bool, optional): dst may exist. Defaults to True.
+
+    Returns:
+        list: size, mtime and inode of dst.
+    """
+    # ! never write in place as dst may be linked to another file
+    if replace and os.path.lexists(dst):
+        os.unlink(dst)
+    done = False
+    if mode == 'hardlink' and 'hardlink' not in UNSUPPORTED:
+        try:
+            os.link(src, dst)
+            done = True
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                UNSUPPORTED.add('hardlink')
+    if (not done and mode in ['hardlink', 'reflink']
+            and 'reflink' not in UNSUPPORTED):
+        try:
+            reflink(src, dst)
+            shutil.copystat(src, dst)
+            done = True
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                UNSUPPORTED.add('reflink')
+            if os.path.lexists(dst):
+                os.unlink(dst)
+    if not done:
+        copy_file_data(src, dst)
+        shutil.copystat(src, dst)
+    dst_stat = os.stat(dst)
+    return [dst_stat.st_size, dst_stat.st_mtime_ns, dst_stat.st_ino]
+
+
+def copy_chunk(src, dst, rel_paths, mode, replace):
+    "Copy a chunk of files, see copy_files()"
+    signatures = {}
+    for rel_path in rel_paths:
+        signatures[rel_path] = materialize(os.path.join(src, rel_path),
+                                           os.path.join(dst, rel_path),
+                                           mode, replace)
+    return signatures
+
+
+def copy_files(src, dst, rel_paths, mode, num_threads, replace=True):
+    """Copy files from src to dst with a pool of threads.
+
+    Small files are dominated by the system calls latency which the threads
+    overlap. Files are dispatched in chunks to amortize the dispatch cost.
+
+    Args:
+        src (str): source directory.
+        dst (str): destination directory.
+        rel_paths (list): path of the files to copy relative to src.
+        mode (str): copy mode, see materialize().
+        num_threads (int): number of copy threads, None for the default.
+        replace (bool, optional): destination files may exist.
+
+    Returns:
+        dict: rel_path -> size, mtime and inode of the copy.
+    """
+    UNSUPPORTED.clear()  # each target may be on a different filesystem
+    chunks = [rel_paths[i: i + COPY_CHUNK_SIZE]
+              for i in range(0, len(rel_paths), COPY_CHUNK_SIZE)]
+    signatures = {}
+
+    # allows non-multithread by setting copy_threads to 1.
+    if num_threads == 1:
+        for chunk in chunks:
+            signatures.update(copy_chunk(src, dst, chunk, mode, replace))
+            PROGBAR.update(len(chunk))
+        return signatures
 
+    with ThreadPoolExecutor(num_threads) as executor:
+        futures = {executor.submit(copy_chunk, src, dst, chunk, mode,
+                                   replace): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            signatures.update(future.result())
+            PROGBAR.update(len(futures[future]))
+    return signatures
 
-def _logprogress(path, names):
-    """"log shutil progress
-    see here: https://docs.python.org/2/library/shutil.html#shutil.Error
+
+def file_signature(path):
+    "Return the size and mtime used to detect that a file changed"
+    file_stat = os.stat(path)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def hash_file(path):
+    "Hash a file from a memory mapping to avoid reading it in memory"
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return hexdigest(b'')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            return hexdigest(mapping)
+
+
+def list_files(src_dir):
+    """Return the path of the directories and files under src_dir relative
+    to it. Symlinked directories are followed, as copytree does.
+    """
+    dirs = []
+    files = []
+    for dir_path, _, filenames in os.walk(src_dir, followlinks=True):
+        rel_dir = os.path.normpath(os.path.relpath(dir_path, src_dir))
+        dirs.append(rel_dir)
+        for filename in filenames:
+            files.append(os.path.normpath(os.path.join(rel_dir, filename)))
+    return dirs, files
+
+
+def copy_dir(src, dst, mode='copy', num_threads=None):
+    """Copy the src directory into dst which must not exist, like
+    shutil.copytree, using the copy engine.
+
+    Returns:
+        dict: rel_path -> size, mtime and inode of the copied files.
+    """
+    if os.path.lexists(dst):
+        raise FileExistsError(dst)
+    dirs, files = list_files(src)
+    for rel_dir in dirs:
+        os.makedirs(os.path.join(dst, rel_dir), exist_ok=True)
+    return copy_files(src, dst, files, mode, num_threads, replace=False)
+
+
+def sync_dir(src, dst, manifest, use_hash=False, delete=False, mode='copy',
+             num_threads=None):
+    """Copy the new and changed files of src into dst.
+
+    A file is skipped if its source size and mtime are the ones recorded in
+    the manifest of the previous copy and the destination was not modified
+    since. With use_hash, a source file whose size or mtime changed is only
+    copied if its content hash changed.
+
+    Args:
+        src (Path): directory to copy.
+        dst (Path): destination directory.
+        manifest (dict): manifest returned by the previous sync.
+        use_hash (bool, optional): compare the content of the files whose
+        size or mtime changed. Defaults to False.
+        delete (bool, optional): remove from dst the files that were copied
+        by a previous sync and no longer exist in src. Defaults to False.
+        mode (str, optional): copy mode, see materialize(). Defaults to copy.
+        num_threads (int, optional): number of copy threads.
+
+    Returns:
+        (dict, dict): the new manifest and the copied, skipped and deleted
+        files counts.
     """
-    PROGBAR.update()
-    return []   # nothing will be ignore
+    new_manifest = {}
+    counts = {'copied': 0, 'skipped': 0, 'deleted': 0}
+    to_copy = {}  # rel_path -> source signature and hash
+    dirs, files = list_files(src)
+    for rel_dir in dirs:
+        os.makedirs(os.path.join(dst, rel_dir), exist_ok=True)
+    for rel_path in files:
+        src_path = os.path.join(src, rel_path)
+        dst_path = os.path.join(dst, rel_path)
+        entry = manifest.get(rel_path)
+        src_signature = file_signature(src_path)
+        src_hash = None
+        try:
+            dst_stat = os.stat(dst_path)
+            dst_signature = [dst_stat.st_size, dst_stat.st_mtime_ns,
+                             dst_stat.st_ino]
+        except FileNotFoundError:
+            dst_signature = None
+
+        # the destination must be the one written by the previous copy
+        if entry and dst_signature == entry['dst']:
+            if src_signature == entry['src']:
+                new_manifest[rel_path] = entry
+                counts['skipped'] += 1
+                PROGBAR.update()
+                continue
+            if use_hash and entry['hash']:
+                src_hash = hash_file(src_path)
+                if src_hash == entry['hash']:
+                    new_manifest[rel_path] = dict(entry, src=src_signature)
+                    counts['skipped'] += 1
+                    PROGBAR.update()
+                    continue
+
+        if use_hash and not src_hash:
+            src_hash = hash_file(src_path)
+        to_copy[rel_path] = (src_signature, src_hash)
+
+    signatures = copy_files(src, dst, list(to_copy), mode, num_threads)
+    for rel_path, (src_signature, src_hash) in to_copy.items():
+        new_manifest[rel_path] = {
+            "src": src_signature,
+            "dst": signatures[rel_path],
+            "hash": src_hash
+        }
+    counts['copied'] = len(to_copy)
+
+    # files copied previously that were removed from the source
+    if delete:
+        for rel_path in manifest:
+            if rel_path not in new_manifest:
+                dst_path = os.path.join(dst, rel_path)
+                if os.path.lexists(dst_path):
+                    os.unlink(dst_path)
+                    counts['deleted'] += 1
+    return new_manifest, counts
 
 
 class CopyDir(SitePreparsing):
@@ -29,17 +326,32 @@ class CopyDir(SitePreparsing):
         log = ""
         errors = False
         targets = config.targets
+        plugin_name = "copy_dir"
+        num_threads = config.copy_threads  # None use the python default
+
+        # files of each destination with their size, mtime and inode. Shared
+        # so the next plugins don't have to walk the copied directories.
+        copied_files = {}
+
+        # how files are copied, shared with the plugins writing the output
+        site.plugin_data['materialize'] = materialize
+
+        # manifests of the previous copies used by the sync mode
+        cache = None
+        if config.sync:
+            cache_file = (site.config.root_dir / site.config.dir.cache /
+                          plugin_name)
+            cache = dc(cache_file)
 
         for target in targets:
-            if '>' not in target:
+            parsed_target = parse_target(target)
+            if not parsed_target:
                 errors = True
                 log += ("[Error] target '%s' is not properly formated<br/>" %
                         target)
                 continue
 
-            src, dst = target.split('>')
-            src = src.strip()
-            dst = dst.strip()
+            src, dst, mode = parsed_target
 
             PROGBAR = tqdm(desc='%s -> %s' % (src, dst), unit='files',
                            leave=False)
@@ -47,8 +359,34 @@ class CopyDir(SitePreparsing):
             src = site.config.root_dir / src
             dst = site.config.root_dir / dst
 
+            if config.sync:
+                manifest_key = "manifest:%s:%s" % (src, dst)
+                try:
+                    manifest, counts = sync_dir(src, dst,
+                                                cache.get(manifest_key, {}),
+                                                use_hash=config.sync_hash,
+                                                delete=config.sync_delete,
+                                                mode=mode,
+                                                num_threads=num_threads)
+                except:  # noqa
+                    errors += 1
+                    log += "[Failed] failed to sync '%s' to '%s' <br/>" % (
+                        src, dst)
+                    PROGBAR.close()
+                    continue
+                cache.set(manifest_key, manifest)
+                copied_files[str(dst)] = {p: e['dst']
+                                          for p, e in manifest.items()}
+                log += ("[OK]synced: '%s' to '%s' copied: %s skipped: %s "
+                        "deleted: %s<br>" % (src, dst, counts['copied'],
+                                             counts['skipped'],
+                                             counts['deleted']))
+                PROGBAR.close()
+                continue
+
             try:
-                shutil.copytree(src, dst, ignore=_logprogress)
+                copied_files[str(dst)] = copy_dir(src, dst, mode=mode,
+                                                  num_threads=num_threads)
             except:  # noqa
                 errors += 1
                 log += "[Failed] failed to copy '%s' to '%s' <br/>" % (src,
@@ -59,6 +397,11 @@ class CopyDir(SitePreparsing):
             log += "[OK]copied: '%s' to '%s'<br>" % (src, dst)
             PROGBAR.close()
 
+        if cache:
+            cache.close()
+
+        site.plugin_data['copy_dir'] = copied_files
+
         if errors:
             return (SiteFab.ERROR, "CopyDir", log)
         else:
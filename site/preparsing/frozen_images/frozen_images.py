@@ -1,16 +1,120 @@
+import os
+from functools import partial
+from io import BytesIO
+
 from PIL import Image, ImageFilter
 from tqdm import tqdm
 import time
 import base64
 from diskcache import Cache as dc
-from io import BytesIO
 from tabulate import tabulate
 
-from sitefab.image import read_image_bytes, convert_image, save_image
+from sitefab.image import convert_image, save_image
 from sitefab.plugins import SitePreparsing
 from sitefab.SiteFab import SiteFab
 
 
+CACHES = {}
+
+
+def get_cache(cache_file):
+    "Return the handle of this process on the frozen images cache."
+    key = (os.getpid(), str(cache_file))
+    if key not in CACHES:
+        CACHES[key] = dc(cache_file)
+    return CACHES[key]
+
+
+def generate_frozen_image(params, img_info):
+    """Generate the frozen image of a given image.
+
+    The cache holds the jpeg bytes along with their data URI so a hit is a
+    single lookup and nothing is written back to the cache.
+    """
+    start_process_time_ts = time.time()
+    frozen_width = params['frozen_width']
+    cache = get_cache(params['cache_file'])
+    row = [img_info['disk_path']]
+    cache_timing = {
+        'fetching': 0,
+        'writing': 0
+    }
+
+    output_filename = "%s.frozen%s" % (img_info['stem'],
+                                       img_info['extension'])
+
+    output_disk_path = img_info['disk_dir'] / output_filename
+    output_web_path = img_info['web_dir'] + output_filename
+
+    # cache fetch
+    start = time.time()
+    cached_value = cache.get(img_info['hash'])
+    cache_timing['fetching'] += time.time() - start
+
+    # generating image
+    if isinstance(cached_value, dict):
+        row.append('HIT')
+    else:
+        if cached_value:
+            # previous versions only cached the jpeg as a BytesIO
+            row.append('UPGRADE')
+            img_io = cached_value
+        else:
+            row.append('MISS')
+            # loading - PIL reads the file directly to avoid copies
+            img = Image.open(img_info['disk_path'])
+
+            # resize - the ratio comes from the full size as the
+            # decoder may downscale the image in draft mode
+            width = img_info['width']
+            height = img_info['height']
+            ratio = float(frozen_width) / width
+            frozen_height = int(height * ratio)  # preserve the ratio
+            # a JPEG is decoded at the smallest DCT scale above twice the
+            # frozen size, plenty for an image that is blurred afterward
+            img.draft(img.mode, (frozen_width * 2, frozen_height * 2))
+            resized_img = img.resize((frozen_width, frozen_height))
+            img.close()
+
+            # convert to make blur working for frozen
+            # ! don't do this for normal images :)
+            resized_img = convert_image(resized_img, 'JPEG',
+                                        return_as_bytesio=False)
+
+            # blur
+            resized_img = resized_img.filter(
+                ImageFilter.GaussianBlur(params['blur_value']))
+
+            # convert
+            img_io = convert_image(resized_img, 'JPEG')
+
+        s = base64.b64encode(img_io.getvalue()).decode('ascii')
+        cached_value = {
+            "jpeg": img_io.getvalue(),
+            "base64": "data:image/jpg;base64,%s" % s
+        }
+
+        # cache storing - only when the entry is new
+        start_set = time.time()
+        cache.set(img_info['hash'], cached_value)
+        cache_timing["writing"] += time.time() - start_set
+
+    # writing to disk, unlinking first a frozen image that copy_dir may have
+    # hardlinked from the sources
+    if os.path.lexists(output_disk_path):
+        os.unlink(output_disk_path)
+    save_image(BytesIO(cached_value['jpeg']), output_disk_path)
+
+    frozen_image = {
+        "url": output_web_path,
+        "base64": cached_value['base64'],
+    }
+
+    row.append('<img src="%s">' % cached_value['base64'])
+    row.append(round(time.time() - start_process_time_ts, 3))
+    return img_info['web_path'], frozen_image, row, cache_timing
+
+
 class FrozenImages(SitePreparsing):
     """
     Create frozen images
@@ -24,11 +128,7 @@ class FrozenImages(SitePreparsing):
         cache_file = site.config.root_dir / site.config.dir.cache / plugin_name
         blur_value = 2
 
-        # opening cache
-        start = time.time()
-        cache = dc(cache_file)
         cache_timing = {
-            'opening': time.time() - start,
             'fetching': 0,
             'writing': 0
         }
@@ -38,81 +138,41 @@ class FrozenImages(SitePreparsing):
             log += 'image_info not found in plugin_data. No images?'
             return (SiteFab.ERROR, plugin_name, log)
 
+        # worker pool shared by the image plugins, published by image_info
+        image_pool = site.plugin_data['image_pool']
+
         # processing images
         images = site.plugin_data['image_info'].values()
         frozen_images = {}
         progress_bar = tqdm(total=len(images), unit=' frozen thumb',
                             desc="Generating frozen images", leave=False)
         log_table = []
-        for img_info in images:
-            start_process_time_ts = time.time()
-            row = [img_info['disk_path']]
-
-            output_filename = "%s.frozen%s" % (img_info['stem'],
-                                               img_info['extension'])
-
-            output_disk_path = img_info['disk_dir'] / output_filename
-            output_web_path = img_info['web_dir'] + output_filename
-
-            # cache fetch
-            start = time.time()
-            cached_value = cache.get(img_info['hash'])
-            cache_timing['fetching'] += time.time() - start
-
-            # generating image
-            start = time.time()
-            if cached_value:
-                row.append('HIT')
-                img_io = cached_value
-            else:
-                row.append('MISS')
-                # loading
-                start = time.time()
-                raw_image = read_image_bytes(img_info['disk_path'])
-
-                img = Image.open(BytesIO(raw_image))
-
-                # resize
-                width, height = img.size
-                ratio = float(frozen_width) / width
-                frozen_height = int(height * ratio)  # preserve the ratio
-                resized_img = img.resize((frozen_width, frozen_height))
-
-                # convert to make blur working for frozen
-                # ! don't do this for normal images :)
-                resized_img = convert_image(resized_img, 'JPEG',
-                                            return_as_bytesio=False)
-
-                # blur
-                resized_img = resized_img.filter(
-                    ImageFilter.GaussianBlur(blur_value))
-
-                # convert
-                img_io = convert_image(resized_img, 'JPEG')
-
-            # cache storing
-            start_set = time.time()
-            cache.set(img_info['hash'], img_io)
-            cache_timing["writing"] += time.time() - start_set
-
-            "IMG manipulation:%ss<br>" % (time.time() - start)
-
-            # writing to disk
-            start = time.time()
-            save_image(img_io, output_disk_path)
-
-            s = base64.b64encode(img_io.getvalue())
-            # this is required due to python3 using b'
-            s = str(s).replace("b'", '').replace("'", '')
-            img_base64 = "data:image/jpg;base64,%s" % (s)
-            # print(img_base64[:64])
-            frozen_images[img_info['web_path']] = {
-                "url": output_web_path,
-                "base64": img_base64,
-            }
-
-            row.append('<img src="%s">' % img_base64)
-            row.append(start_process_time_ts)
+        params = {
+            "cache_file": cache_file,
+            "frozen_width": frozen_width,
+            "blur_value": blur_value
+        }
+        generate = partial(generate_frozen_image, params)
+
+        # allows non-multithread by setting threads to 1. The results are
+        # collected in order so the output is the same as the serial path.
+        # With a memory budget the images are only dispatched while their
+        # decoded pixels fit in it.
+        memory_budget = config.memory_budget
+        if site.config.threads > 1 and len(images) > 1 and memory_budget:
+            log += "Memory budget: %s MB<br>" % memory_budget
+            results = image_pool.imap_budget(
+                generate, images, [image_pool.decoded_size(i) for i in images],
+                memory_budget * 1024 * 1024)
+        elif site.config.threads > 1 and len(images) > 1:
+            results = image_pool.get().imap(generate, images)
+        else:
+            results = map(generate, images)
+
+        for web_path, frozen_image, row, timing in results:
+            frozen_images[web_path] = frozen_image
+            for k, v in timing.items():
+                cache_timing[k] += v
             progress_bar.update(1)
             log_table.append(row)
 
@@ -120,8 +180,13 @@ class FrozenImages(SitePreparsing):
         site.plugin_data['frozen_images'] = frozen_images
 
         log += tabulate(log_table, tablefmt='html')
+        log += "<h3>Cache stats</h3>"
+        log += tabulate([
+            ['fetching', cache_timing['fetching']],
+            ['writing', cache_timing['writing']]
+        ], tablefmt='html')
         progress_bar.close()
-        cache.close()
+        image_pool.release(site, plugin_name)
 
         if errors:
             return (SiteFab.ERROR, plugin_name, log)
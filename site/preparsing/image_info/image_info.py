@@ -1,71 +1,629 @@
 import math
+import mmap
+import os
+import queue
+import re
+import struct
 import time
-from io import BytesIO
+import zlib
+from functools import partial
+from itertools import chain
 from pathlib import Path
+import numpy as np
 from diskcache import Cache
 from PIL import Image
-from sitefab import files
-from sitefab.image import (image_hash, normalize_image_extension,
-                           read_image_bytes)
+from sitefab.image import image_hash, normalize_image_extension
 from sitefab.plugins import SitePreparsing
 from sitefab.SiteFab import SiteFab
 from tabulate import tabulate
 from tqdm import tqdm
 from multiprocessing import get_context
 
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif']
+# directories modified less than 2s before being listed are listed again on
+# the next run as a change in the same mtime tick would not be detected.
+RACY_MTIME_NS = 2 * 10 ** 9
+# name of the images generated next to the originals by the thumbnails,
+# responsive_images, frozen_images and image_pipeline plugins:
+# photo-thumb-120x120.jpg, photo.300.webp and photo.frozen.jpg
+DERIVATIVE_NAME = re.compile(r'^(.+?)(?:-thumb-\d+x\d+|\.\d+|\.frozen)$')
 
-def extract_image_info(bundle):
 
-    image_full_path, cache_file, site_output_dir = bundle
-    # open cache
-    cache = Cache(cache_file)
+def find_images(input_dir, dir_index):
+    """Walk input_dir once and return the images it contains.
 
-    row = [image_full_path]
-    disk_dir = image_full_path.parents[0]
-    img_filename = image_full_path.name
-    file_size = image_full_path.stat().st_size
-    # File info extraction
-    img_stem = image_full_path.stem
-    img_extension = image_full_path.suffix
-    pil_extension_codename, web_extension = normalize_image_extension(img_extension)  # noqa
+    Extensions are matched case insensitively. dir_index maps each
+    directory to its mtime and content from the previous run: directories
+    which mtime didn't change are not listed again as adding, removing or
+    renaming an entry updates the directory mtime.
 
-    # directories
-    web_path = str(image_full_path).replace(str(site_output_dir), "/")
-    web_path = web_path.replace('\\', '/').replace('//', '/')
-    web_dir = web_path.replace(img_filename, '')
+    Args:
+        input_dir (Path): directory to walk.
+        dir_index (dict): index returned by the previous run.
 
-    # loading
-    start = time.time()
-    raw_image = read_image_bytes(image_full_path)
+    Returns:
+        (list, dict, int): images path as str, new index, num directories
+        listed.
+    """
+    images = []
+    new_index = {}
+    num_listed = 0
+    stack = [str(input_dir)]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+
+        indexed = dir_index.get(dir_path)
+        if indexed and indexed[0] == mtime:
+            filenames, subdirs = indexed[1], indexed[2]
+        else:
+            num_listed += 1
+            listing_ts = time.time_ns()
+            filenames = []
+            subdirs = []
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:  # noqa
+                        filenames.append(entry.name)
+            if mtime > listing_ts - RACY_MTIME_NS:
+                mtime = -1  # don't trust it next time
+
+        new_index[dir_path] = [mtime, filenames, subdirs]
+        images.extend([os.path.join(dir_path, f) for f in filenames])
+        stack.extend([os.path.join(dir_path, d) for d in subdirs])
+    return images, new_index, num_listed
+
+
+def images_from_copied_files(input_dir, copied_files):
+    """Return the images under input_dir from the files copied by copy_dir.
+
+    Args:
+        input_dir (Path): images directory.
+        copied_files (dict): copy_dir destinations mapped to their files
+        path relative to it and size, mtime and inode.
+
+    Returns:
+        dict: image path as str -> signature. None if input_dir is not in a
+        directory copied by copy_dir in which case it must be walked.
+    """
+    input_dir = os.path.normpath(str(input_dir))
+    covered = False
+    for dst in copied_files:
+        dst = os.path.normpath(dst)
+        if input_dir == dst or input_dir.startswith(dst + os.sep):
+            covered = True
+    if not covered:
+        return None
+
+    images = {}
+    for dst, files in copied_files.items():
+        for rel_path, signature in files.items():
+            path = os.path.normpath(os.path.join(dst, rel_path))
+            if (path.startswith(input_dir + os.sep)
+                    and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS):  # noqa
+                images[path] = signature
+    return images
+
+
+def remove_derivatives(images):
+    """Remove from images the derivatives written by a previous build when
+    the output directory is not wiped between builds, e.g. with copy_dir
+    sync. An image is a derivative if its name matches DERIVATIVE_NAME and
+    an image with the matching stem exists in the same directory.
+
+    Args:
+        images (list): images path as str.
+
+    Returns:
+        list: images that are not derivatives.
+    """
+    stems = set([os.path.splitext(path)[0] for path in images])
+    originals = []
+    for path in images:
+        match = DERIVATIVE_NAME.match(os.path.splitext(path)[0])
+        if match and match.group(1) in stems:
+            continue
+        originals.append(path)
+    return originals
+
+
+# worker processes keep their cache handles open between tasks and plugins
+CACHES = {}
 
-    io_img = BytesIO(raw_image)
+
+def get_cache(cache_file):
+    "Return the cache handle of the current process, opening it once."
+    key = (os.getpid(), str(cache_file))
+    if key not in CACHES:
+        CACHES[key] = Cache(cache_file)
+    return CACHES[key]
+
+
+# streaming resize of the very large PNG images: they are decoded by strips
+# of about STRIP_PIXELS pixels, reduced by an integer factor that leaves at
+# least REDUCING_GAP for the LANCZOS filter, and resized strip by strip.
+STREAMING_MODES = ['L', 'LA', 'RGB', 'RGBA']
+PREMULTIPLIED_MODES = {'LA': 'La', 'RGBA': 'RGBa'}
+STRIP_PIXELS = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+REDUCING_GAP = 3
+LANCZOS_SUPPORT = 3
+
+
+def can_stream(img):
+    "Can the opened but not loaded image be decoded by strips?"
+    # 8 bits per band, non interlaced PNG whose rows are read as is
+    return (img.format == 'PNG' and img.mode in STREAMING_MODES
+            and not img.info.get('interlace') and len(img.tile) == 1
+            and img.tile[0][3] == img.mode)
+
+
+def png_strips(img, strip_height):
+    """Decode a PNG by strips of strip_height rows, only one in memory.
+
+    The IDAT chunks are inflated incrementally and each strip is unfiltered
+    by the PIL PNG decoder. The last row of the previous strip, unfiltered,
+    is prepended to the strip as the filters reference the row above.
+    """
+    width = img.width
+    row_size = 1 + width * len(img.mode)
+    strip_size = row_size * strip_height
+    inflate = zlib.decompressobj()
+    data = bytearray()
+    previous_row = b''
+
+    def decode_strip(rows):
+        num_rows = (len(previous_row) + len(rows)) // row_size
+        strip = Image.new(img.mode, (width, num_rows))
+        decoder = Image._getdecoder(img.mode, 'zip', img.mode,
+                                    img.decoderconfig)
+        decoder.setimage(strip.im, (0, 0, width, num_rows))
+        # stored zlib stream: no compression cost, the decoder copies it
+        decoder.decode(zlib.compress(previous_row + rows, 0))
+        decoder.cleanup()
+        if previous_row:
+            strip = strip.crop((0, 1, width, num_rows))
+        return strip
+
+    with open(img.filename, 'rb') as f:
+        f.seek(8)  # PNG signature
+        while True:
+            length, chunk_type = struct.unpack('>I4s', f.read(8))
+            if chunk_type == b'IEND':
+                break
+            if chunk_type != b'IDAT':
+                f.seek(length + 4, os.SEEK_CUR)  # skip data and crc
+                continue
+            # some encoders write a single IDAT chunk: it is read by pieces
+            # and never inflated by more than a strip at once
+            while length:
+                compressed = f.read(min(length, READ_SIZE))
+                length -= len(compressed)
+                while compressed:
+                    data += inflate.decompress(compressed, strip_size)
+                    compressed = inflate.unconsumed_tail
+                    if len(data) >= strip_size:
+                        strip = decode_strip(bytes(data[:strip_size]))
+                        del data[:strip_size]
+                        previous_row = b'\0' + strip.crop(
+                            (0, strip.height - 1, width, strip.height)
+                        ).tobytes()
+                        yield strip
+            f.seek(4, os.SEEK_CUR)  # crc
+    data += inflate.flush()
+    if data:
+        yield decode_strip(bytes(data))
+
+
+def stream_resize(img, size):
+    """Resize with LANCZOS an opened but not loaded image without decoding
+    it entirely. Peak memory is a few strips of the image plus the output.
+
+    Strips are reduced by an integer factor with Image.reduce(), which is
+    exact on strips whose height is a multiple of the factor, like
+    Image.resize() does with reducing_gap. The reduced rows are kept in a
+    window until the output rows that need them are resized: the window
+    always extends past the filter support so each output row sees the same
+    source rows as a resize of the whole image.
+
+    Images with alpha are resized premultiplied and never reduced, as
+    Image.resize() does whatever its reducing_gap.
+    """
+    width, height = img.size
+    mode = PREMULTIPLIED_MODES.get(img.mode, img.mode)
+    if mode != img.mode:
+        factor = 1
+    else:
+        factor = max(1, int(min(width / size[0], height / size[1]) /
+                            REDUCING_GAP))
+    strip_height = max(1, STRIP_PIXELS // width // factor) * factor
+    reduced_width = width / factor
+    reduced_height = -(-height // factor)
+    scale = height / factor / size[1]
+    margin = int(math.ceil(LANCZOS_SUPPORT * max(scale, 1))) + 2
+
+    # strips are premultiplied once, resize() would convert the window again
+    # for each group of output rows
+    resized = Image.new(mode, size)
+    window = None
+    window_top = 0  # reduced row of the first row of the window
+    next_row = 0  # first output row not resized yet
+    for strip in png_strips(img, strip_height):
+        if strip.mode != mode:
+            strip = strip.convert(mode)
+        if factor > 1:
+            strip = strip.reduce(factor)
+        if window:
+            rows = Image.new(mode, (strip.width,
+                                        window.height + strip.height))
+            rows.paste(window, (0, 0))
+            rows.paste(strip, (0, window.height))
+            window = rows
+        else:
+            window = strip
+        window_bottom = window_top + window.height
+        if window_bottom == reduced_height:
+            last_row = size[1]
+        else:
+            last_row = min(int((window_bottom - margin) / scale), size[1])
+        if last_row > next_row:
+            box = (0, next_row * scale - window_top, reduced_width,
+                   last_row * scale - window_top)
+            rows = window.resize((size[0], last_row - next_row),
+                                 Image.LANCZOS, box=box)
+            resized.paste(rows, (0, next_row))
+            next_row = last_row
+        # drop the rows above the filter support of the next output row
+        top = max(int(next_row * scale) - margin, window_top)
+        window = window.crop((0, top - window_top, window.width,
+                              window.height))
+        window_top = top
+    if mode != img.mode:
+        resized = resized.convert(img.mode)
+    return resized
+
+
+# derivatives are resized from an intermediate bitmap of the same kind only
+# if it is at least this many times larger, closer sizes would soften them
+PYRAMID_MIN_RATIO = 2
+
+
+def plan_resizes(sizes):
+    """Pick the bitmap each derivative size of an image is resized from.
+
+    Args:
+        sizes (list): (width, height) of the derivatives, e.g. the scaled
+        sizes of the thumbnails before cropping or the responsive sizes.
+
+    Returns:
+        dict: size -> smallest size at least PYRAMID_MIN_RATIO times larger,
+        None to resize from the decoded image.
+    """
+    plan = {}
+    for size in sorted(set(sizes), reverse=True):
+        parents = [s for s in plan if s[0] >= size[0] * PYRAMID_MIN_RATIO
+                   and s[1] >= size[1] * PYRAMID_MIN_RATIO]
+        plan[size] = min(parents) if parents else None
+    return plan
+
+
+def thumbnail_scaled_size(img_width, img_height, thumb_width, thumb_height):
+    "Size to scale the image to before cropping it to the thumbnail size"
+    # scale on the smallest side to maximize quality
+    if img_width < img_height:
+        ratio = img_height / float(img_width)
+
+        # take into account thumb requested ratio
+        if thumb_width * ratio > thumb_height:
+            ratio2 = thumb_width / float(img_width)
+            tmp_height = int(img_height * ratio2)
+            return (thumb_width, tmp_height)
+        else:
+            ratio2 = thumb_height / float(img_height)
+            tmp_width = int(img_width * ratio2)
+            return (tmp_width, thumb_height)
+    else:
+        ratio = float(img_width) / img_height
+        if thumb_height * ratio > thumb_width:
+            ratio2 = thumb_height / float(img_height)
+            tmp_width = int(img_width * ratio2)
+            return (tmp_width, thumb_height)
+        else:
+            ratio2 = thumb_width / float(img_width)
+            tmp_height = int(img_height * ratio2)
+            return (thumb_width, tmp_height)
+
+
+def crop_thumbnail(thumb_img, thumb_width, thumb_height):
+    "Center crop the scaled image to the thumbnail size"
+    scaled_width, scaled_height = thumb_img.size
+
+    # cropping box as ratio of the scaled image centered on the middle
+    left, right, top, bottom = 0.0, 1.0, 0.0, 1.0
+    ratio_width = thumb_width / float(scaled_width)
+    if ratio_width < 1:
+        # FIXME: potentially compute using interest points
+        center = float(scaled_width) * 0.5
+        left = (center - thumb_width / 2) / float(scaled_width)
+        right = left + ratio_width
+        # correcting potential overflow
+        if left < 0:
+            right -= left
+            left = 0.0
+        if right > 1:
+            left -= (right - 1.0)
+            right = 1.0
+
+    ratio_height = thumb_height / float(scaled_height)
+    if ratio_height < 1:
+        center = float(scaled_height) * 0.5
+        top = (center - thumb_height / 2) / float(scaled_height)
+        bottom = top + ratio_height
+        if top < 0:
+            bottom -= top
+            top = 0.0
+        if bottom > 1:
+            top -= (bottom - 1.0)
+            bottom = 1.0
+
+    left_pixel = int(scaled_width * left)
+    top_pixel = int(scaled_height * top)
+    right_pixel = int(scaled_width * right)
+    bottom_pixel = int(scaled_height * bottom)
+
+    # happen when both are at .5
+    if right_pixel - left_pixel != thumb_width:
+        right_pixel += thumb_width - (right_pixel - left_pixel)
+    if bottom_pixel - top_pixel != thumb_height:
+        bottom_pixel += thumb_height - (bottom_pixel - top_pixel)
+
+    return thumb_img.crop([left_pixel, top_pixel, right_pixel, bottom_pixel])
+
+
+# image plugins using the shared worker pool, the last of them to run in the
+# preparsing stage closes it
+IMAGE_POOL_PLUGINS = ['image_info', 'image_resizer', 'thumbnails',
+                      'frozen_images', 'responsive_images', 'image_pipeline']
+
+
+class ImagePool(object):
+    """Worker pool shared by the image preparsing plugins.
+
+    image_info publishes it in site.plugin_data['image_pool'] and the other
+    image plugins, which all depend on image_info, only use that entry. The
+    workers are forked on first use, once per build instead of once per
+    plugin, and closed by the last of IMAGE_POOL_PLUGINS to run.
+    """
+
+    # image code shared by the image plugins, the pool is sent to their
+    # workers without the worker processes to use it
+    can_stream = staticmethod(can_stream)
+    stream_resize = staticmethod(stream_resize)
+    plan_resizes = staticmethod(plan_resizes)
+    thumbnail_scaled_size = staticmethod(thumbnail_scaled_size)
+    crop_thumbnail = staticmethod(crop_thumbnail)
+
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.plugins = IMAGE_POOL_PLUGINS
+        self.pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def get(self):
+        "Return the worker pool, forking the workers on first use."
+        if not self.pool:
+            self.pool = get_context("fork").Pool(self.num_threads)
+        return self.pool
+
+    def release(self, site, plugin_name):
+        """Close and join the workers if plugin_name is the last enabled
+        image plugin to run in the preparsing stage, and remove the pool
+        from site.plugin_data so templates never see it.
+
+        Outside of sitefab, when the plugins are unknown, the workers are
+        closed after each plugin and forked again by the next one.
+        """
+        plugins = site.plugins
+        if plugins:
+            for name in self.plugins:
+                if (name != plugin_name and name in plugins.plugins_enabled
+                        and name not in plugins.plugins_executed):
+                    return
+            site.plugin_data.pop('image_pool', None)
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    @staticmethod
+    def decoded_size(img_info):
+        """Estimate from its info the memory used by the decoded pixels of an
+        image in bytes: width x height x bands. Info cached before the bands
+        were recorded is assumed RGBA if lossless and RGB otherwise.
+        """
+        bands = img_info.get('bands') or (4 if img_info['lossless'] else 3)
+        return img_info['width'] * img_info['height'] * bands
+
+    def imap_budget(self, func, tasks, costs, budget, ordered=True):
+        """Like imap(), or imap_unordered() if ordered is False, but a task is
+        only sent to the workers when its cost plus the cost of the tasks in
+        progress fits in budget. A task costlier than the budget runs alone.
+
+        Args:
+            func (function): function applied to each task.
+            tasks (list): tasks to process.
+            costs (list): memory used by each task, e.g. the decoded_size()
+            of the images it decodes.
+            budget (int): maximum cost of the tasks in progress.
+            ordered (bool, optional): yield the results in the tasks order.
+            Defaults to True.
+        """
+        pool = self.get()
+        done = queue.Queue()
+        results = {}
+        num_in_flight = cost_in_flight = 0  # tasks submitted not completed
+        next_result = 0
+
+        def wait_result():
+            nonlocal num_in_flight, cost_in_flight
+            idx, cost, result, error = done.get()
+            num_in_flight -= 1
+            cost_in_flight -= cost
+            if error is not None:
+                raise error
+            results[idx] = result
+
+        def ready_results():
+            nonlocal next_result
+            if not ordered:
+                while results:
+                    yield results.popitem()[1]
+            while next_result in results:
+                yield results.pop(next_result)
+                next_result += 1
+
+        for idx, (task, cost) in enumerate(zip(tasks, costs)):
+            while num_in_flight and cost_in_flight + cost > budget:
+                wait_result()
+                yield from ready_results()
+            num_in_flight += 1
+            cost_in_flight += cost
+            pool.apply_async(
+                func, (task,),
+                callback=lambda r, i=idx, c=cost: done.put((i, c, r, None)),
+                error_callback=lambda e, i=idx, c=cost: done.put(
+                    (i, c, None, e)))
+        while num_in_flight:
+            wait_result()
+            yield from ready_results()
+
+
+def image_signature(image_full_path):
+    "Return the stat signature used to detect that an image is unchanged"
+    file_stat = os.stat(image_full_path)
+    return [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+
+
+def hash_image_file(image_full_path):
+    """Hash an image straight from a memory mapping of the file so its
+    encoded bytes are never copied in memory.
+    """
+    with open(image_full_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            return image_hash(mapping)
+
+
+def lookup_cached_info(cache, image_full_path, signature=None):
+    """Return the cached info of an image if its size, mtime and inode did
+    not change since the last run. This avoid reading and hashing the image.
+    signature is the current one if already known.
+    """
+    manifest = cache.get("manifest:%s" % image_full_path)
+    if not manifest:
+        return None
+    if not signature:
+        signature = image_signature(image_full_path)
+    if manifest['signature'] == signature:
+        return cache.get(manifest['cache_key'])
+    return None
+
+
+def lookup_image_info(params, image_full_path):
+    """Hash an image and look up its info in the cache without decoding it.
+
+    Returns:
+        dict: state of the image for compute_image_info(). Its info is None
+        if the image must be decoded, in which case decoded_size is the size
+        of its pixels from the header if a memory budget is set.
+    """
+    process_start_ts = time.time()
+    cache = get_cache(params['cache_file'])
+    file_signature = image_signature(image_full_path)
 
     # hash
     # we use the hash of the content to make sure we regnerate if
     # the image content is different
-    img_hash = image_hash(raw_image)
-    row.append(img_hash)
+    img_hash = hash_image_file(image_full_path)
 
     # ! this cache_key take into account the name and content
     # ! this not done in other plugins as we want to dedup computation
     # ! if the filename is different but content the same.
     cache_key = "%s:%s" % (image_full_path, img_hash)
-    cached_info = cache.get(cache_key)
-
-    if cached_info:
+    state = {
+        "path": image_full_path,
+        "signature": file_signature,
+        "hash": img_hash,
+        "cache_key": cache_key,
+        "info": cache.get(cache_key),
+        "decoded_size": 0
+    }
+    if not state['info'] and params['memory_budget']:
+        # only the header is read: width x height x bands
+        with Image.open(image_full_path) as img:
+            state['decoded_size'] = img.width * img.height * len(
+                img.getbands())
+    state['time'] = time.time() - process_start_ts
+    return state
+
+
+def compute_image_info(params, state):
+    """Compute the info of an image looked up by lookup_image_info(),
+    decoding it only if its info was not in the cache.
+
+    The cache is only read here, the entries to store are returned so the
+    caller can write them all at once.
+    """
+    site_output_dir = params['site_output_dir']
+    process_start_ts = time.time()
+    cache_entries = {}
+
+    image_full_path = state['path']
+    img_hash = state['hash']
+    cache_key = state['cache_key']
+    row = [image_full_path, img_hash]
+    file_signature = state['signature']
+    file_size = file_signature[0]
+
+    if state['info']:
         # cached info available so just assign it
-        info = cached_info
+        info = state['info']
         row.append(0)
     else:
+        disk_dir = image_full_path.parents[0]
+        img_filename = image_full_path.name
+        # File info extraction
+        img_stem = image_full_path.stem
+        img_extension = image_full_path.suffix
+        pil_extension_codename, web_extension = normalize_image_extension(img_extension)  # noqa
+
+        # directories
+        web_path = str(image_full_path).replace(str(site_output_dir), "/")
+        web_path = web_path.replace('\\', '/').replace('//', '/')
+        web_dir = web_path.replace(img_filename, '')
+
         # new image we are computing everything
-        img = Image.open(io_img)
+        # PIL reads the file itself: no in memory copy of the encoded image
+        img = Image.open(image_full_path)
 
-        # width and height
+        # width, height and bands
         width, height = img.size
+        bands = len(img.getbands())
         row.append("%sx%s" % (width, height))
 
         # Find dominant color
-        ct = ColorThief(img)
+        if params['color_engine'] == 'numpy':
+            ct = NumpyColorThief(img)
+        else:
+            ct = ColorThief(img)
         dc = ct.get_color()
         # convert color to web
         dominant_color = "#" + "".join([hex(v)[2:] for v in dc])
@@ -95,17 +653,29 @@ def extract_image_info(bundle):
             "lossless": lossless,                     # image is lossless
             "width": width,
             "height": height,
+            "bands": bands,
             "file_size": file_size,
             "hash": img_hash,
             "dominant_color": dominant_color
         }
 
         # logging
-        row.append(round(time.time() - start, 3))
+        row.append(round(state['time'] + time.time() - process_start_ts, 3))
+
+        cache_entries[cache_key] = info
 
-    cache.set(cache_key, info)
-    cache.close()
-    return info, row
+    cache_entries["manifest:%s" % image_full_path] = {
+        "signature": file_signature,
+        "cache_key": cache_key
+    }
+    process_time = state['time'] + time.time() - process_start_ts
+    return info, row, cache_entries, process_time
+
+
+def extract_image_info(params, image_full_path):
+    "Compute the info of an image that was not resolved from the cache."
+    return compute_image_info(params,
+                              lookup_image_info(params, image_full_path))
 
 
 class ImageInfo(SitePreparsing):
@@ -121,12 +691,40 @@ class ImageInfo(SitePreparsing):
         cache_file = site.config.root_dir / site.config.dir.cache / plugin_name
         site_output_dir = site.config.root_dir / site.config.dir.output
 
+        # worker pool of all the image plugins, published first so they
+        # find it even if no image is processed here
+        image_pool = ImagePool(site.config.threads)
+        site.plugin_data['image_pool'] = image_pool
+
         # reading images list
         if not input_dir:
             return (SiteFab.ERROR, plugin_name, "no input_dir specified")
 
-        images = files.get_files_list(input_dir, ["*.jpg", "*.jpeg", "*.png",
-                                                  "*.gif"])
+        cache = get_cache(cache_file)
+
+        # images discovery: reuse the list of files copied by copy_dir if
+        # it covers the input_dir, else only list directories that changed
+        start = time.time()
+        index_key = "dir_index:%s" % input_dir
+        signatures = None
+        if not config.verify:
+            signatures = images_from_copied_files(
+                input_dir, site.plugin_data.get('copy_dir', {}))
+        if signatures is not None:
+            images = list(signatures)
+            dir_index = None
+            log += "Images discovery: %s images from copy_dir in %ss<br>" % (
+                len(images), round(time.time() - start, 3))
+        else:
+            signatures = {}
+            if config.verify:
+                dir_index = {}
+            else:
+                dir_index = cache.get(index_key, {})
+            images, dir_index, num_listed = find_images(input_dir, dir_index)
+            log += "Images discovery: %s/%s directories listed in %ss<br>" % (
+                num_listed, len(dir_index), round(time.time() - start, 3))
+        images = remove_derivatives(images)
         num_images = len(images)
 
         if num_images == 0:
@@ -140,24 +738,105 @@ class ImageInfo(SitePreparsing):
 
         # compute info
         # pack info for multiprocess
-        bundles = [[i, cache_file, site_output_dir] for i in images]
+        params = {
+            "cache_file": cache_file,
+            "site_output_dir": site_output_dir,
+            "color_engine": config.dominant_color_engine or 'python',
+            "memory_budget": (config.memory_budget or 0) * 1024 * 1024,
+            # force reading and hashing every image
+            "verify": bool(config.verify)
+        }
+        if params['verify']:
+            log += "Verify mode: all images are read and hashed<br>"
+
+        # resolve the cache hits in one read transaction so only the misses
+        # are sent to the workers
+        start = time.time()
         results = []
+        misses = []
+        if params['verify']:
+            misses = images
+        else:
+            with cache.transact():
+                for image_full_path in images:
+                    info = lookup_cached_info(cache, image_full_path,
+                                              signatures.get(image_full_path))
+                    if info:
+                        results.append([info, [image_full_path, info['hash'],
+                                               0]])
+                        progress_bar.update(1)
+                    else:
+                        misses.append(image_full_path)
+        prefetch_time = time.time() - start
+
+        misses = [Path(i) for i in misses]
+        # ! params are pickled with every image sent to the workers
+        extract = partial(extract_image_info, params)
+        cache_entries = {}
+        if dir_index is not None:
+            cache_entries[index_key] = dir_index
+        misses_time = 0
         # allows non-multithread by setting threads to 1.
-        if site.config.threads > 1:
+        if site.config.threads > 1 and len(misses) > 1:
             log += "Using multithreading: %s threads<br>" % (
                 site.config.threads)
 
-            tpool = get_context("fork").Pool(site.config.threads)  # fix for mac
-            for data in tpool.imap_unordered(extract_image_info, bundles):
-                results.append(data)
+            tpool = image_pool.get()
+            if params['memory_budget']:
+                # images are hashed without budget, only the ones missing
+                # from the cache are decoded within it
+                log += "Memory budget: %s MB<br>" % config.memory_budget
+                found = []
+                to_decode = []
+                lookup = partial(lookup_image_info, params)
+                for state in tpool.imap_unordered(lookup, misses):
+                    if state['info']:
+                        # same content, e.g. copied again: nothing to decode
+                        found.append(compute_image_info(params, state))
+                    else:
+                        to_decode.append(state)
+                data_iter = chain(found, image_pool.imap_budget(
+                    partial(compute_image_info, params), to_decode,
+                    [state['decoded_size'] for state in to_decode],
+                    params['memory_budget'], ordered=False))
+            else:
+                data_iter = tpool.imap_unordered(extract, misses)
+            for data in data_iter:
+                info, row, entries, process_time = data
+                results.append([info, row])
+                cache_entries.update(entries)
+                misses_time += process_time
                 progress_bar.update(1)
-            tpool.close()
-            tpool.join()
         else:
-            for bundle in bundles:
-                results.append(extract_image_info(bundle))
+            for image_full_path in misses:
+                info, row, entries, process_time = extract(image_full_path)
+                results.append([info, row])
+                cache_entries.update(entries)
+                misses_time += process_time
                 progress_bar.update(1)
         progress_bar.close()
+        image_pool.release(site, plugin_name)
+
+        # committing the new entries in a single transaction
+        start = time.time()
+        with cache.transact():
+            for key, value in cache_entries.items():
+                cache.set(key, value)
+        writing_time = time.time() - start
+
+        num_hits = num_images - len(misses)
+        if misses:
+            time_saved = num_hits * misses_time / len(misses) - prefetch_time
+        else:
+            time_saved = 0
+        log += "<h3>Cache stats</h3>"
+        log += tabulate([
+            ['hits', num_hits],
+            ['misses', len(misses)],
+            ['prefetch', round(prefetch_time, 3)],
+            ['writing', round(writing_time, 3)],
+            ['estimated time saved', round(time_saved, 3)]
+        ], tablefmt='html')
 
         # store data
         for data in results:
@@ -166,7 +845,6 @@ class ImageInfo(SitePreparsing):
             info['disk_path'] = Path(info['disk_path'])
             info['disk_dir'] = Path(info['disk_dir'])
             image_info[info['web_path']] = info
-            progress_bar.update(1)
             log_table.append(row)
 
         log += tabulate(log_table, headers=['filename', 'size', 'hash',
@@ -257,6 +935,23 @@ class ColorThief(object):
         return cmap.palette
 
 
+class NumpyColorThief(ColorThief):
+    """Color thief that samples and filters the pixels with NumPy and
+    quantize them with NumpyMMCQ. Returns the same palette as ColorThief.
+    """
+
+    def get_palette(self, color_count=10, quality=10):
+        image = self.image.convert('RGBA')
+        pixels = np.asarray(image).reshape(-1, 4)[::quality]
+        r, g, b, a = pixels.T
+        # If pixel is mostly opaque and not white
+        valid = (a >= 125) & ~((r > 250) & (g > 250) & (b > 250))
+        valid_pixels = pixels[valid, :3]
+
+        cmap = NumpyMMCQ.quantize(valid_pixels, color_count)
+        return cmap.palette
+
+
 class MMCQ(object):
     """Basic Python port of the MMCQ (modified median cut quantization)
     algorithm from the Leptonica library (http://www.leptonica.com/).
@@ -384,19 +1079,19 @@ class MMCQ(object):
                 return (vbox1, vbox2)
         return (None, None)
 
-    @staticmethod
-    def quantize(pixels, max_color):
+    @classmethod
+    def quantize(cls, pixels, max_color):
         """Quantize.
 
         :param pixels: a list of pixel in the form (r, g, b)
         :param max_color: max number of colors
         """
-        if not pixels:
+        if not len(pixels):
             raise Exception('Empty pixels when quantize.')
         if max_color < 2 or max_color > 256:
             raise Exception('Wrong number of max colors when quantize.')
 
-        histo = MMCQ.get_histo(pixels)
+        histo = cls.get_histo(pixels)
 
         # check that we aren't below maxcolors already
         if len(histo) <= max_color:
@@ -404,7 +1099,7 @@ class MMCQ(object):
             pass
 
         # get the beginning vbox from the colors
-        vbox = MMCQ.vbox_from_pixels(pixels, histo)
+        vbox = cls.vbox_from_pixels(pixels, histo)
         pq = PQueue(lambda x: x.count)
         pq.push(vbox)
 
@@ -419,7 +1114,7 @@ class MMCQ(object):
                     n_iter += 1
                     continue
                 # do the cut
-                vbox1, vbox2 = MMCQ.median_cut_apply(histo, vbox)
+                vbox1, vbox2 = cls.median_cut_apply(histo, vbox)
                 if not vbox1:
                     raise Exception("vbox1 not defined; shouldn't happen!")
                 lh.push(vbox1)
@@ -451,6 +1146,98 @@ class MMCQ(object):
         return cmap
 
 
+class NumpyMMCQ(MMCQ):
+    """MMCQ where the histogram is a 32x32x32 NumPy array built with
+    bincount and the median cuts are computed with cumulative sums. The
+    iteration order is the one of MMCQ so the palette is identical.
+    """
+
+    @staticmethod
+    def get_histo(pixels):
+        """histo (3-d array indexed by the quantized r, g, b values)
+        """
+        q = (pixels >> MMCQ.RSHIFT).astype(np.int64)
+        index = (q[:, 0] << (2 * MMCQ.SIGBITS)) + (q[:, 1] << MMCQ.SIGBITS)
+        index += q[:, 2]
+        size = 1 << MMCQ.SIGBITS
+        histo = np.bincount(index, minlength=size ** 3)
+        return histo.reshape(size, size, size)
+
+    @staticmethod
+    def vbox_from_pixels(pixels, histo):
+        q = pixels >> MMCQ.RSHIFT
+        rmin, gmin, bmin = [int(v) for v in q.min(axis=0)]
+        rmax, gmax, bmax = [int(v) for v in q.max(axis=0)]
+        return NumpyVBox(rmin, rmax, gmin, gmax, bmin, bmax, histo)
+
+    @staticmethod
+    def median_cut_apply(histo, vbox):
+        if not vbox.count:
+            return (None, None)
+
+        rw = vbox.r2 - vbox.r1 + 1
+        gw = vbox.g2 - vbox.g1 + 1
+        bw = vbox.b2 - vbox.b1 + 1
+        maxw = max([rw, gw, bw])
+        # only one pixel, no split
+        if vbox.count == 1:
+            return (vbox.copy, None)
+
+        # Find the partial sum arrays along the selected axis.
+        if maxw == rw:
+            do_cut_color = 'r'
+            sums = vbox.cube.sum(axis=(1, 2))
+        elif maxw == gw:
+            do_cut_color = 'g'
+            sums = vbox.cube.sum(axis=(0, 2))
+        else:  # maxw == bw
+            do_cut_color = 'b'
+            sums = vbox.cube.sum(axis=(0, 1))
+        partialsum = [int(v) for v in np.cumsum(sums)]
+        total = partialsum[-1]
+
+        # determine the cut planes
+        dim1 = do_cut_color + '1'
+        dim2 = do_cut_color + '2'
+        dim1_val = getattr(vbox, dim1)
+        dim2_val = getattr(vbox, dim2)
+
+        # same lookups as the dicts used by MMCQ: 0 outside of the box
+        def partial_sum(i):
+            if dim1_val <= i <= dim2_val:
+                return partialsum[i - dim1_val]
+            return 0
+
+        def lookahead(i):
+            if dim1_val <= i <= dim2_val:
+                return total - partialsum[i - dim1_val]
+            return None
+
+        cut = int(np.argmax(np.asarray(partialsum) > (total / 2)))
+        if partialsum[cut] <= total / 2:
+            return (None, None)
+        i = dim1_val + cut
+        vbox1 = vbox.copy
+        vbox2 = vbox.copy
+        left = i - dim1_val
+        right = dim2_val - i
+        if left <= right:
+            d2 = min([dim2_val - 1, int(i + right / 2)])
+        else:
+            d2 = max([dim1_val, int(i - 1 - left / 2)])
+        # avoid 0-count boxes
+        while not partial_sum(d2):
+            d2 += 1
+        count2 = lookahead(d2)
+        while not count2 and partial_sum(d2 - 1):
+            d2 -= 1
+            count2 = lookahead(d2)
+        # set dimensions
+        setattr(vbox1, dim2, d2)
+        setattr(vbox2, dim1, getattr(vbox1, dim2) + 1)
+        return (vbox1, vbox2)
+
+
 class VBox(object):
     """3d color space box"""
     def __init__(self, r1, r2, g1, g2, b1, b2, histo):
@@ -471,8 +1258,8 @@ class VBox(object):
 
     @property
     def copy(self):
-        return VBox(self.r1, self.r2, self.g1, self.g2,
-                    self.b1, self.b2, self.histo)
+        return type(self)(self.r1, self.r2, self.g1, self.g2,
+                          self.b1, self.b2, self.histo)
 
     @cached_property
     def avg(self):
@@ -526,6 +1313,45 @@ class VBox(object):
         return npix
 
 
+class NumpyVBox(VBox):
+    """3d color space box over a NumPy histogram"""
+
+    @property
+    def cube(self):
+        return self.histo[self.r1:self.r2 + 1,
+                          self.g1:self.g2 + 1,
+                          self.b1:self.b2 + 1]
+
+    @cached_property
+    def avg(self):
+        mult = 1 << (8 - MMCQ.SIGBITS)
+        cube = self.cube
+        ntot = int(cube.sum())
+
+        if ntot:
+            # hval * (i + 0.5) * mult == hval * (2i + 1) * mult / 2 which
+            # keeps the sums exact and the averages equal to VBox ones.
+            sums = []
+            for axis, start in enumerate([self.r1, self.g1, self.b1]):
+                other_axes = tuple(a for a in range(3) if a != axis)
+                plane = cube.sum(axis=other_axes)
+                weights = 2 * np.arange(start, start + len(plane)) + 1
+                sums.append(int((plane * weights).sum()) * mult / 2)
+            r_avg = int(sums[0] / ntot)
+            g_avg = int(sums[1] / ntot)
+            b_avg = int(sums[2] / ntot)
+        else:
+            r_avg = int(mult * (self.r1 + self.r2 + 1) / 2)
+            g_avg = int(mult * (self.g1 + self.g2 + 1) / 2)
+            b_avg = int(mult * (self.b1 + self.b2 + 1) / 2)
+
+        return r_avg, g_avg, b_avg
+
+    @cached_property
+    def count(self):
+        return int(self.cube.sum())
+
+
 class CMap(object):
     """Color map"""
     def __init__(self):
@@ -0,0 +1,514 @@
+import base64
+import os
+import time
+from functools import partial
+
+from diskcache import Cache as dc
+from PIL import Image, ImageFilter
+from tabulate import tabulate
+from tqdm import tqdm
+
+from sitefab.image import convert_image, image_hash
+from sitefab.image import normalize_image_extension
+from sitefab.plugins import SitePreparsing
+from sitefab.SiteFab import SiteFab
+
+FROZEN_WIDTH = 42
+FROZEN_BLUR = 2
+DEFAULT_CACHE_SIZE_LIMIT = 1024  # in MB
+
+CACHES = {}
+
+
+def get_cache(cache_file):
+    "Return the handle of this process on the derivatives cache."
+    key = (os.getpid(), str(cache_file))
+    if key not in CACHES:
+        CACHES[key] = dc(cache_file)
+    return CACHES[key]
+
+
+def store_derivative(store_dir, img_io):
+    """Write an encoded derivative in the content addressed store.
+
+    Returns:
+        dict: the derivative hash and size used to find it back.
+    """
+    buf = img_io.getbuffer()
+    entry = {"hash": image_hash(buf), "file_size": buf.nbytes}
+    path = store_dir / entry['hash'][:2] / entry['hash']
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename so a concurrent reader never see a partial file
+        tmp_path = path.with_name("%s.%s.tmp" % (path.name, os.getpid()))
+        with open(tmp_path, 'wb') as f:
+            f.write(buf)
+        os.replace(tmp_path, path)
+    return entry
+
+
+def prune_store(store_dir, last_used, in_use, size_limit):
+    """Delete the least recently used derivatives of the store until it
+    fits in size_limit. The derivatives of the current build are never
+    removed: their output files may be hardlinked to them so it would not
+    free any space.
+
+    Args:
+        store_dir (Path): content addressed store.
+        last_used (dict): derivative hash -> timestamp of the last build
+        that used it. Derivatives missing from it are removed first.
+        in_use (set): hash of the derivatives of the current build.
+        size_limit (int): maximum size of the store in bytes.
+
+    Returns:
+        (set, set, int): hash of the derivatives kept and removed, store
+        size.
+    """
+    derivatives = []
+    store_size = 0
+    for subdir in store_dir.iterdir() if store_dir.exists() else []:
+        with os.scandir(subdir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.tmp'):
+                    # left over by an interrupted build
+                    os.unlink(entry.path)
+                    continue
+                size = entry.stat().st_size
+                store_size += size
+                derivatives.append((last_used.get(entry.name, 0), size,
+                                    entry.name, entry.path))
+
+    kept = set()
+    removed = set()
+    derivatives.sort()
+    for _, size, name, path in derivatives:
+        if store_size > size_limit and name not in in_use:
+            os.unlink(path)
+            store_size -= size
+            removed.add(name)
+        else:
+            kept.add(name)
+    return kept, removed, store_size
+
+
+def frozen_image(img, width, height):
+    """Generate the small blurred image used as a placeholder. width and
+    height are the full size of the image which may be decoded smaller.
+    """
+    ratio = float(FROZEN_WIDTH) / width
+    resized_img = img.resize((FROZEN_WIDTH, int(height * ratio)))
+    # convert to make blur working for frozen
+    resized_img = convert_image(resized_img, 'JPEG', return_as_bytesio=False)
+    resized_img = resized_img.filter(ImageFilter.GaussianBlur(FROZEN_BLUR))
+    return convert_image(resized_img, 'JPEG')
+
+
+def process_image(params, img_info):
+    """Generate all the derivatives of an image while decoding it at most
+    once. Derivatives are cached individually and the image is only decoded
+    if at least one of them is missing from the cache.
+    """
+    start_process_ts = time.time()
+    cache = get_cache(params['cache_file'])
+    store_dir = params['store_dir']
+    image_pool = params['image_pool']  # for the image code it shares
+    num_errors = 0
+    num_miss = 0
+    used = set()  # hash of the derivatives materialized
+
+    # decoded images, computed on demand and shared by all derivatives
+    bitmaps = {}
+
+    def get_original():
+        if 'original' not in bitmaps:
+            img = Image.open(img_info['disk_path'])
+            threshold = params['streaming_threshold']
+            if (resize_master and threshold and img.size != master_size
+                    and img.width * img.height > threshold * 1000 * 1000
+                    and image_pool.can_stream(img)):
+                # never decoded entirely: the master stands for the original
+                streamed = image_pool.stream_resize(img, master_size)
+                img.close()
+                img = streamed
+            elif resize_master:
+                # everything but the frozen image is derived from the master
+                # so the JPEG decoder only needs to produce twice its size
+                img.draft(img.mode, (master_size[0] * 2, master_size[1] * 2))
+            img.load()
+            bitmaps['original'] = img
+        return bitmaps['original']
+
+    def get_master():
+        if 'master' not in bitmaps:
+            img = get_original()
+            # the original is already replaced if the master was cached
+            if resize_master and img.size != master_size:
+                img = img.resize(master_size, Image.LANCZOS)
+            bitmaps['master'] = img
+        return bitmaps['master']
+
+    def get_resized(source_name, get_source, plan, size):
+        "Resize the source bitmap following the resize pyramid plan"
+        key = (source_name, size)
+        if key not in bitmaps:
+            if plan[size]:
+                parent = get_resized(source_name, get_source, plan, plan[size])
+            else:
+                parent = get_source()
+            bitmaps[key] = parent.resize(size, Image.LANCZOS)
+        return bitmaps[key]
+
+    def get_thumbnail(size):
+        key = "thumb-%sx%s" % size
+        if key not in bitmaps:
+            scaled_size = image_pool.thumbnail_scaled_size(
+                master_width, master_height, size[0], size[1])
+            scaled_img = get_resized('master', get_master, thumbs_plan,
+                                     scaled_size)
+            bitmaps[key] = image_pool.crop_thumbnail(scaled_img, size[0],
+                                                     size[1])
+        return bitmaps[key]
+
+    def get_derivative(cache_key, generate, output_path):
+        """Materialize a derivative from the store at output_path, generating
+        it first if needed. The cache maps the derivative key which is
+        (source hash, operation, parameters) to its hash in the store.
+        """
+        nonlocal num_miss
+        entry = cache.get(cache_key)
+        # !entries written before the store was added are BytesIO
+        if (not isinstance(entry, dict)
+                or not (store_dir / entry['hash'][:2] / entry['hash']).exists()):  # noqa
+            num_miss += 1
+            entry = store_derivative(store_dir, generate())
+            cache.set(cache_key, entry)
+        store_path = store_dir / entry['hash'][:2] / entry['hash']
+        if not (os.path.lexists(output_path)
+                and os.path.samefile(store_path, output_path)):
+            # not already linked to the store by a previous build
+            params['materialize'](store_path, output_path,
+                                  params['materialize_mode'])
+        used.add(entry['hash'])
+        return entry, store_path
+
+    # size of the master, needed first to know how much the decoder can
+    # downscale the original
+    max_width = params['max_width']
+    resize_master = max_width and img_info['width'] >= max_width
+    if resize_master:
+        ratio = max_width / float(img_info['width'])
+        master_size = (max_width, int(img_info['height'] * ratio))
+
+    # frozen - computed from the original image like the frozen_images plugin
+    frozen = None
+    if params['frozen_images']:
+        key = "%s:frozen" % img_info['hash']
+        output_filename = "%s.frozen%s" % (img_info['stem'],
+                                           img_info['extension'])
+        entry, store_path = get_derivative(
+            key, lambda: frozen_image(get_original(), img_info['width'],
+                                      img_info['height']),
+            img_info['disk_dir'] / output_filename)
+        with open(store_path, 'rb') as f:
+            s = base64.b64encode(f.read()).decode('ascii')
+        frozen = {
+            "url": img_info['web_dir'] + output_filename,
+            "base64": "data:image/jpg;base64,%s" % s
+        }
+
+    # master - resized version of the image that replace the original
+    master = None
+    master_info = dict(img_info)
+    # all derivatives below are computed from the master
+    derivative_prefix = "%s:%s" % (img_info['hash'], max_width)
+    if resize_master:
+        key = "%s:master:%s:%s" % (derivative_prefix, params['jpeg_quality'],
+                                   params['webp_quality'])
+        entry, _ = get_derivative(key, lambda: convert_image(
+            get_master(), img_info['pil_extension'],
+            jpeg_quality=params['jpeg_quality'],
+            webp_quality=params['webp_quality'],
+            webp_lossless=img_info['lossless']), img_info['disk_path'])
+        master = [master_size[0], master_size[1], entry['file_size'],
+                  entry['hash']]
+        master_info['width'], master_info['height'] = master_size
+        master_info['file_size'], master_info['hash'] = master[2:]
+
+    # thumbnails - the scaled images are computed with a resize pyramid
+    if resize_master:
+        master_width, master_height = master_size
+    else:
+        master_width, master_height = img_info['width'], img_info['height']
+    thumbs_plan = image_pool.plan_resizes([
+        image_pool.thumbnail_scaled_size(master_width, master_height, w, h)
+        for w, h in params['thumbnail_sizes']])
+    thumbs = {}
+    thumbs_info = {}
+    thumbs_size = {}  # used to find back the decoded thumbnail
+    for thumb_width, thumb_height in params['thumbnail_sizes']:
+        thumb_size = (thumb_width, thumb_height)
+        thumb_key = "%sx%s" % thumb_size
+        output_filename = "%s-thumb-%s%s" % (img_info['stem'], thumb_key,
+                                             img_info['extension'])
+        output_disk_path = img_info['disk_dir'] / output_filename
+        output_web_path = img_info['web_dir'] + output_filename
+        thumbs[thumb_key] = output_web_path
+
+        key = "%s:thumb:%s" % (derivative_prefix, thumb_key)
+        entry, _ = get_derivative(key, lambda: convert_image(
+            get_thumbnail(thumb_size), img_info['pil_extension'],
+            webp_lossless=img_info['lossless']), output_disk_path)
+
+        extension = output_disk_path.suffix
+        pil_ext, web_ext = normalize_image_extension(extension)
+        thumbs_info[output_web_path] = {
+            "filename": output_disk_path.name,
+            "stem": output_disk_path.stem,
+            "extension": extension,
+            "disk_path": output_disk_path,
+            "disk_dir": output_disk_path.parents[0],
+            "web_path": output_web_path,
+            "web_dir": img_info['web_dir'],
+            "pil_extension": pil_ext,
+            "mime_type": web_ext,
+            "lossless": extension in ['.png', '.gif'],
+            "width": thumb_width,
+            "height": thumb_height,
+            "file_size": entry['file_size'],
+            "hash": entry['hash']
+        }
+        thumbs_size[output_web_path] = thumb_size
+
+    # responsive images for the master and its thumbnails
+    responsive = []
+    if not params['responsive_widths']:
+        responsive_sources = []
+    else:
+        responsive_sources = [master_info] + list(thumbs_info.values())
+    for info in responsive_sources:
+        if info['web_path'] in thumbs_size:
+            size = thumbs_size[info['web_path']]
+            get_bitmap = (lambda size=size: get_thumbnail(size))
+            key_prefix = "%s:thumb:%sx%s" % ((derivative_prefix,) + size)
+        else:
+            get_bitmap = get_master
+            key_prefix = derivative_prefix
+
+        requested_extensions = set(params['additional_formats'])
+        requested_extensions.add(info['extension'])
+
+        width = info['width']
+        height = info['height']
+        resize_list = {}
+        s = "%s %sw" % (info['web_path'], width)
+        resize_list[info['mime_type']] = [s]
+
+        # the resized bitmaps are shared by all the formats and computed
+        # with a resize pyramid
+        sizes = [(w, int(height * float(w) / width))
+                 for w in params['responsive_widths'] if w <= width]
+        plan = image_pool.plan_resizes(sizes)
+
+        for requested_width, requested_height in sizes:
+            def resize(info=info, get_bitmap=get_bitmap, plan=plan,
+                       size=(requested_width, requested_height)):
+                return get_resized(info['web_path'], get_bitmap, plan, size)
+
+            for extension in requested_extensions:
+                pil_codename, web_extension = normalize_image_extension(extension)  # noqa
+                if not pil_codename:
+                    num_errors += 1
+                    continue
+                if web_extension not in resize_list:
+                    resize_list[web_extension] = []
+
+                output_filename = "%s.%s%s" % (info['stem'], requested_width,
+                                               extension)
+                key = "%s:responsive:%s-%s" % (key_prefix, pil_codename,
+                                               requested_width)
+                get_derivative(key, lambda: convert_image(
+                    resize(), pil_codename, webp_lossless=info['lossless']),
+                    info['disk_dir'] / output_filename)
+
+                s = "%s %sw" % (info['web_dir'] + output_filename,
+                                requested_width)
+                resize_list[web_extension].append(s)
+
+        responsive.append([info['web_path'], resize_list, width,
+                           info['hash']])
+
+    for img in bitmaps.values():
+        img.close()
+
+    decoded = 'original' in bitmaps
+    row = [img_info['disk_path'], num_miss, decoded,
+           round(time.time() - start_process_ts, 3)]
+    return (img_info['web_path'], master, thumbs, thumbs_info, responsive,
+            frozen, num_errors, used, row)
+
+
+class ImagePipeline(SitePreparsing):
+    """
+    Generate all image derivatives with a single decode per image
+    """
+
+    def process(self, unused, site, config):
+        log = ""
+        errors = False
+        plugin_name = "image_pipeline"
+        cache_dir = site.config.root_dir / site.config.dir.cache
+        cache_file = cache_dir / plugin_name
+
+        # using the list of images from image_info
+        if 'image_info' not in site.plugin_data:
+            log += 'image_info not found in plugin_data. No images?'
+            return (SiteFab.ERROR, plugin_name, log)
+
+        # worker pool shared by the image plugins, published by image_info
+        image_pool = site.plugin_data['image_pool']
+
+        params = {
+            "cache_file": cache_file,
+            "store_dir": cache_dir / ("%s_store" % plugin_name),
+            "materialize": site.plugin_data['materialize'],
+            "materialize_mode": config.materialize or 'hardlink',
+            "max_width": config.max_width,
+            "jpeg_quality": config.jpeg_quality or 85,
+            "webp_quality": config.webp_quality or 80,
+            "thumbnail_sizes": config.thumbnail_sizes or [],
+            "responsive_widths": config.responsive_widths or [],
+            "additional_formats": config.additional_formats or [],
+            "frozen_images": config.frozen_images,
+            "streaming_threshold": config.streaming_threshold,
+            "image_pool": image_pool
+        }
+
+        images = list(site.plugin_data['image_info'].values())
+        process = partial(process_image, params)
+        progress_bar = tqdm(total=len(images), unit=' images',
+                            desc="Generating images derivatives", leave=False)
+        results = []
+        # allows non-multithread by setting threads to 1.
+        if site.config.threads > 1:
+            log += "Using multithreading: %s threads<br>" % (
+                site.config.threads)
+            tpool = image_pool.get()
+            memory_budget = config.memory_budget
+            if memory_budget:
+                # images are only dispatched while their decoded pixels fit
+                log += "Memory budget: %s MB<br>" % memory_budget
+                data_iter = image_pool.imap_budget(
+                    process, images,
+                    [image_pool.decoded_size(i) for i in images],
+                    memory_budget * 1024 * 1024, ordered=False)
+            else:
+                data_iter = tpool.imap_unordered(process, images)
+            for data in data_iter:
+                results.append(data)
+                progress_bar.update(1)
+        else:
+            for img_info in images:
+                results.append(process(img_info))
+                progress_bar.update(1)
+        progress_bar.close()
+        image_pool.release(site, plugin_name)
+
+        image_info = site.plugin_data['image_info']
+        all_thumbs = {}
+        all_thumbs_info = {}
+        resize_images = {}
+        frozen_images = {}
+        log_table = []
+        build_ts = time.time()
+        in_use = set()
+        for result in results:
+            (web_path, master, thumbs, thumbs_info, responsive, frozen,
+             num_errors, used, row) = result
+            log_table.append(row)
+            in_use.update(used)
+            if num_errors:
+                errors = True
+
+            # update image info to reflect the resized master
+            if master:
+                width, height, file_size, file_hash = master
+                image_info[web_path]['width'] = width
+                image_info[web_path]['height'] = height
+                image_info[web_path]['file_size'] = file_size
+                image_info[web_path]['hash'] = file_hash
+
+            if params['thumbnail_sizes']:
+                all_thumbs[web_path] = thumbs
+                all_thumbs_info.update(thumbs_info)
+
+            if frozen:
+                frozen_images[web_path] = frozen
+
+            # same structure as the responsive_images plugin
+            for img_path, resize_list, width, img_hash in responsive:
+                srcsets = {}
+                allsizes = {}
+                last = None
+                for webformat, srcset in resize_list.items():
+                    if webformat == "image/webp":
+                        key = 'webp'
+                    else:
+                        key = 'original'
+
+                    for img in srcset:
+                        img_data = img.split(" ")
+                        size = img_data[1][:-1]
+                        if size not in allsizes:
+                            allsizes[size] = {}
+                        allsizes[size][key] = img_data[0]
+                        if key == 'original':
+                            last = img_data[0]
+                    srcsets[key] = {
+                        'srcset': ", ".join(srcset),
+                        'format': webformat
+                    }
+
+                resize_images[img_path] = {
+                    "srcsets": srcsets,
+                    "media": '(max-width: %spx)' % width,
+                    "sizes": '(max-width: %spx)' % width,
+                    "hash": img_hash,
+                    "allsizes": allsizes,
+                    "last": last
+                }
+
+        # expose the derivatives under the keys used by the standalone plugins
+        image_info.update(all_thumbs_info)
+        if params['thumbnail_sizes']:
+            site.plugin_data['thumbnails'] = all_thumbs
+        if params['responsive_widths']:
+            site.plugin_data['responsive_images'] = resize_images
+        if params['frozen_images']:
+            site.plugin_data['frozen_images'] = frozen_images
+
+        # keep the store within the size limit, evicting the derivatives
+        # that were not used for the longest time
+        cache = get_cache(cache_file)
+        size_limit = config.cache_size_limit or DEFAULT_CACHE_SIZE_LIMIT
+        last_used = cache.get('store_last_used', {})
+        last_used.update({h: build_ts for h in in_use})
+        kept, removed, store_size = prune_store(
+            params['store_dir'], last_used, in_use, size_limit * 1024 * 1024)
+        with cache.transact():
+            if removed:
+                # forget the entries pointing to the removed derivatives
+                for key in list(cache.iterkeys()):
+                    entry = cache.get(key)
+                    if isinstance(entry, dict) and entry.get('hash') in removed:  # noqa
+                        cache.delete(key)
+            cache.set('store_last_used', {h: ts for h, ts in last_used.items()
+                                          if h in kept})
+        log += "Store size: %s MB / %s MB, %s derivatives removed<br>" % (
+            round(store_size / (1024 * 1024), 1), size_limit, len(removed))
+
+        log += tabulate(log_table, headers=['file', 'cache misses', 'decoded',
+                                            'process time'], tablefmt='html')
+        if errors:
+            return (SiteFab.ERROR, plugin_name, log)
+        else:
+            return (SiteFab.OK, plugin_name, log)
@@ -1,29 +1,84 @@
-from multiprocessing import get_context
-from itertools import repeat
+import os
+from functools import partial
+from io import BytesIO
 
 from PIL import Image
 from tqdm import tqdm
 import time
 from diskcache import Cache as dc
-from io import BytesIO
 from tabulate import tabulate
 
-from sitefab.image import save_image, convert_image, read_image_bytes
+from sitefab.image import save_image, convert_image
 from sitefab.image import image_hash
 from sitefab.plugins import SitePreparsing
 from sitefab.SiteFab import SiteFab
 
 
-def resize_image(data):
-    img_info, site_data = data
+# bumped each time the layout of the cache entries changes
+CACHE_VERSION = 2
+DEFAULT_CACHE_SIZE_LIMIT = 1024  # in MB
+
+CACHES = {}
+
+
+def get_cache(cache_file, **settings):
+    "Return the handle of this process on the resized images cache."
+    key = (os.getpid(), str(cache_file))
+    if key not in CACHES:
+        CACHES[key] = dc(cache_file, **settings)
+    else:
+        # the handle may be opened with other settings by a previous build
+        for name, value in settings.items():
+            CACHES[key].reset(name, value)
+    return CACHES[key]
+
+
+def resized_image_key(img_info, max_width, jpeg_quality, webp_quality):
+    """Return the cache key of a resized image.
+
+    Only the encoder settings that apply to the image codec are part of the
+    key so changing the webp quality does not invalidate the jpeg images.
+    """
+    codec = img_info['pil_extension']
+    if codec == 'JPEG':
+        quality = "q%s" % jpeg_quality
+    elif codec == 'WEBP':
+        quality = "lossless" if img_info['lossless'] else "q%s" % webp_quality
+    else:
+        quality = "default"
+    return "resized:%s:%s:%s:%s" % (img_info['hash'], max_width, codec,
+                                    quality)
+
+
+def migrate_cache(cache):
+    """Drop the entries written by the previous cache layouts.
+
+    They were keyed by the source hash only and did not record the encoder
+    settings, so there is no way to tell which configuration produced them.
+    Returns the number of entries removed.
+    """
+    if cache.get('cache_version') == CACHE_VERSION:
+        return 0
+    num_removed = 0
+    with cache.transact():
+        for key in list(cache.iterkeys()):
+            if not str(key).startswith('resized:'):
+                cache.delete(key)
+                num_removed += 1
+        cache.set('cache_version', CACHE_VERSION)
+    return num_removed
+
+
+def resize_image(site_data, img_info):
     img_path = img_info['web_path']
     log_str = ""
     width = 0
     height = 0
     file_size = 0
     file_hash = ""
-    cache_file, max_width, jpeg_quality, webp_quality = site_data
-    cache = dc(cache_file)
+    (cache_file, max_width, jpeg_quality, webp_quality,
+     streaming_threshold, image_pool) = site_data
+    cache = get_cache(cache_file)
 
     process_start_ts = time.time()
     row = [img_info['disk_path']]
@@ -33,37 +88,39 @@ def resize_image(data):
                                                          max_width)
         return img_path, log_str, row, width, height, file_size, file_hash
 
-    # cache fetch
-    # start = time.time()
-    cached_version = cache.get(img_info['hash'])
-
-    # Do we have a cached version else creating it
+    # the key covers every setting that changes the output
+    cache_key = resized_image_key(img_info, max_width, jpeg_quality,
+                                  webp_quality)
+    cached_version = cache.get(cache_key)
     if cached_version:
-        raw_image = cached_version['raw_image']
-        row.append(0)
-    else:
-        start = time.time()
-        raw_image = read_image_bytes(img_info['disk_path'])
-        row.append((round(time.time() - start, 5)))
-
-        cached_version = {}
-        cached_version['raw_image'] = raw_image
-        cached_version['max_width'] = -1
-
-    # Is the cached version have the right size?
-    if cached_version['max_width'] == max_width:
         row.append('HIT')
-        resized_img_io = cached_version['resized_img']
-        resized_img = Image.open(resized_img_io)
+        row.append(0)
+        resized_img_io = BytesIO(cached_version['resized_img'])
+        width = cached_version['width']
+        height = cached_version['height']
     else:
         row.append('MISS')
-        img = Image.open(BytesIO(raw_image))
-        img_width, img_height = img.size
-
-        ratio = max_width / float(img_width)
-        new_height = int(img_height * ratio)
-        resized_img = img.resize((max_width, new_height),
-                                 Image.LANCZOS)
+        # PIL reads the file itself: no in memory copy of the encoded image.
+        # It must be closed before the resized image overwrite the file.
+        start = time.time()
+        ratio = max_width / float(img_info['width'])
+        new_height = int(img_info['height'] * ratio)
+        img = Image.open(img_info['disk_path'])
+        num_pixels = img_info['width'] * img_info['height']
+        if (streaming_threshold and image_pool.can_stream(img)
+                and num_pixels > streaming_threshold * 1000 * 1000):
+            # decoded and resized by strips, never entirely in memory
+            row.append('streamed')
+            resized_img = image_pool.stream_resize(img,
+                                                   (max_width, new_height))
+        else:
+            # a JPEG is decoded at 1/2, 1/4 or 1/8 of its size when that
+            # still leaves twice max_width to the LANCZOS resize
+            img.draft(img.mode, (max_width * 2, new_height * 2))
+            img.load()
+            row.append((round(time.time() - start, 5)))
+            resized_img = img.resize((max_width, new_height),
+                                     Image.LANCZOS)
         img.close()
 
         extension_codename = img_info['pil_extension']
@@ -71,23 +128,25 @@ def resize_image(data):
                                        jpeg_quality=jpeg_quality,
                                        webp_quality=webp_quality,
                                        webp_lossless=img_info['lossless'])
-
-        cached_version['max_width'] = max_width
-        cached_version['resized_img'] = resized_img_io
-
-    # writing to disk
-    start = time.time()
+        width, height = resized_img.size
+
+        # only the encoded output is kept, never the original
+        cache.set(cache_key, {
+            "width": width,
+            "height": height,
+            "resized_img": resized_img_io.getvalue()
+        })
+
+    # writing to disk: the original is replaced, never overwritten in place,
+    # as copy_dir may have hardlinked it to the source image
+    os.unlink(img_info['disk_path'])
     save_image(resized_img_io, img_info['disk_path'])
 
     # update image info to reflect new image info
     # it is mandatory to update the hash as other plugins rely on
     # it to detect change
-    width, height = resized_img.size
     file_size = resized_img_io.getbuffer().nbytes
     file_hash = image_hash(resized_img_io.getbuffer())
-    # cache storing
-    cache.set(img_info['hash'], cached_version)
-    cache.close()
     row.append(round(time.time() - process_start_ts, 2))
     return img_path, log_str, row, width, height, file_size, file_hash
 
@@ -106,19 +165,45 @@ class ImageResizer(SitePreparsing):
             log += 'image_info not found in plugin_data. No images?'
             return (SiteFab.ERROR, plugin_name, log)
 
+        # worker pool shared by the image plugins, published by image_info
+        image_pool = site.plugin_data['image_pool']
+
+        # the size limit is stored in the cache settings so the workers
+        # enforce it as well when they add entries
+        size_limit = config.cache_size_limit or DEFAULT_CACHE_SIZE_LIMIT
+        cache = get_cache(cache_file, size_limit=size_limit * 1024 * 1024,
+                          eviction_policy='least-recently-used')
+        num_removed = migrate_cache(cache)
+        if num_removed:
+            log += "Removed %s entries from the previous cache format<br>" % (
+                num_removed)
+
         # processing images
         images = site.plugin_data['image_info'].values()
         progress_bar = tqdm(total=len(images), unit=' image',
                             desc="Resizing images", leave=False)
 
         log_table = []
-        p = get_context("fork").Pool(config.threads)
-
         site_data = (cache_file, config.max_width, config.jpeg_quality,
-                     config.webp_quality)
+                     config.webp_quality, config.streaming_threshold,
+                     image_pool)
+        resize = partial(resize_image, site_data)
+
+        # allows non-multithread by setting threads to 1. With a memory
+        # budget the images are only dispatched while their decoded pixels
+        # fit in it.
+        memory_budget = config.memory_budget
+        if site.config.threads > 1 and memory_budget:
+            log += "Memory budget: %s MB<br>" % memory_budget
+            results = image_pool.imap_budget(
+                resize, images, [image_pool.decoded_size(i) for i in images],
+                memory_budget * 1024 * 1024, ordered=False)
+        elif site.config.threads > 1:
+            results = image_pool.get().imap_unordered(resize, images)
+        else:
+            results = map(resize, images)
 
-        # multithreaded loop
-        for img_path, log_str, row, width, height, file_size, file_hash in p.imap_unordered(resize_image, zip(images, repeat(site_data))):  # noqa
+        for img_path, log_str, row, width, height, file_size, file_hash in results:  # noqa
             log += log_str
             log_table.append(row)
             if width != 0:
@@ -127,9 +212,12 @@ class ImageResizer(SitePreparsing):
                 site.plugin_data['image_info'][img_path]['file_size'] = file_size  # noqa
                 site.plugin_data['image_info'][img_path]['hash'] = file_hash  # noqa
             progress_bar.update(1)
-        p.close()
-        p.join()
         progress_bar.close()
+        image_pool.release(site, plugin_name)
+        # evict the least recently used entries if above the size limit
+        cache.cull()
+        log += "Cache size: %s MB / %s MB<br>" % (
+            round(cache.volume() / (1024 * 1024), 1), size_limit)
 
         log += tabulate(log_table, tablefmt='html')
         if errors:
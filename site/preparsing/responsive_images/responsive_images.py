@@ -1,24 +1,174 @@
+import os
 import pprint
-import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import BytesIO
-from itertools import repeat
-from multiprocessing import get_context
 from tabulate import tabulate
 
 from diskcache import Cache as dc
 from PIL import Image
 from tqdm import tqdm
 
-from sitefab.image import read_image_bytes, normalize_image_extension
+from sitefab.image import normalize_image_extension
 from sitefab.image import convert_image, save_image
 from sitefab.plugins import SitePreparsing
 from sitefab.SiteFab import SiteFab
 
 
-def generate_thumbnails(bundle):
-    "generate thumbnails for a set of images"
-    images, params = bundle
+# bumped each time the layout of the cache entries changes
+CACHE_VERSION = 2
+DEFAULT_CACHE_SIZE_LIMIT = 1024  # in MB
+
+# relative cost of an image served from the cache: only the files are written
+CACHE_HIT_COST_RATIO = 0.01
+
+# scheduling units per worker: enough for the pool to balance the load
+# without paying the dispatch overhead for every cheap image
+UNITS_PER_WORKER = 8
+
+
+def derivative_key(img_hash, codec, width):
+    "Cache key of a responsive image: one entry per source, codec and width"
+    return "%s:%s-%s" % (img_hash, codec, width)
+
+
+def migrate_cache(cache):
+    """Split the entries of the previous cache layout, which held all the
+    derivatives of an image in a single dict keyed by the image hash, into
+    one entry per derivative. Only runs once per cache.
+
+    Returns the number of entries split.
+    """
+    if cache.get('cache_version') == CACHE_VERSION:
+        return 0
+    num_split = 0
+    with cache.transact():
+        # the derivative keys all contain a ':', not the image hashes
+        for key in [k for k in cache.iterkeys() if ':' not in str(k)]:
+            legacy_value = cache.get(key)
+            if isinstance(legacy_value, dict):
+                for secondary_key, img_io in legacy_value.items():
+                    cache.set("%s:%s" % (key, secondary_key),
+                              img_io.getvalue())
+                cache.delete(key)
+                num_split += 1
+        cache.set('cache_version', CACHE_VERSION)
+    return num_split
+
+
+def estimate_cost(image_info, params, cache):
+    """Estimate the cost of generating the responsive images of an image.
+
+    The resize and encoding cost grows with the number of pixels times the
+    number of outputs, and is negligible for the outputs in the cache.
+    """
+    width = image_info['width']
+    widths = [w for w in params['requested_width_list'] if w <= width]
+    formats = set(params['requested_format_list'])
+    formats.add(image_info['extension'])
+    num_outputs = len(widths) * len(formats)
+    num_cached = 0
+    if width >= params['min_image_width']:
+        for extension in formats:
+            codec = normalize_image_extension(extension)[0]
+            for w in widths:
+                if derivative_key(image_info['hash'], codec, w) in cache:
+                    num_cached += 1
+    num_missing = num_outputs - num_cached
+    return width * image_info['height'] * (
+        num_missing + num_cached * CACHE_HIT_COST_RATIO)
+
+
+def schedule_batches(images, costs, num_workers):
+    """Split the images in batches of similar cost, most expensive first.
+
+    Expensive images get a batch of their own while cheap ones are grouped,
+    and as the pool hands out the batches in order the long running ones
+    start first instead of being the tail of the build.
+
+    Args:
+        images (list): image_info of the images to process.
+        costs (list): estimated cost of each image.
+        num_workers (int): number of workers processing the batches.
+
+    Returns:
+        list: batches of images_info, most expensive first.
+    """
+    unit_cost = sum(costs) / float(num_workers * UNITS_PER_WORKER)
+    batches = []
+    batch = []
+    batch_cost = 0
+    for cost, image_info in sorted(zip(costs, images), key=lambda x: x[0],
+                                   reverse=True):
+        batch.append(image_info)
+        batch_cost += cost
+        if batch_cost >= unit_cost:
+            batches.append(batch)
+            batch = []
+            batch_cost = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+CACHES = {}
+
+
+def get_cache(cache_file, **settings):
+    "Return the handle of this process on the responsive images cache."
+    key = (os.getpid(), str(cache_file))
+    if key not in CACHES:
+        CACHES[key] = dc(cache_file, **settings)
+    else:
+        # the handle may be opened with other settings by a previous build
+        for name, value in settings.items():
+            CACHES[key].reset(name, value)
+    return CACHES[key]
+
+
+# encoding threads of the current process, created on first use
+ENCODERS = {}
+
+
+def encode_variants(img, codecs, lossless, num_threads):
+    """Encode an image in several formats.
+
+    Pillow encoders release the GIL so when num_threads > 1 the formats are
+    encoded concurrently by threads of the worker process. This keeps the
+    cores busy when only a few large images changed.
+
+    Args:
+        img (PIL.Image): the resized image to encode.
+        codecs (list): PIL codec names of the formats to generate.
+        lossless (bool): is the source image lossless.
+        num_threads (int): number of encoding threads.
+
+    Returns:
+        dict: codec -> encoded image as BytesIO.
+    """
+    if num_threads <= 1 or len(codecs) < 2:
+        return {codec: convert_image(img, codec, webp_lossless=lossless)
+                for codec in codecs}
+
+    key = (os.getpid(), num_threads)
+    if key not in ENCODERS:
+        ENCODERS[key] = ThreadPoolExecutor(num_threads)
+    # ! each thread gets its own copy as Image.save() stores the encoder
+    # settings on the image object
+    futures = {codec: ENCODERS[key].submit(convert_image, img.copy(), codec,
+                                           webp_lossless=lossless)
+               for codec in codecs}
+    return {codec: future.result() for codec, future in futures.items()}
+
+
+def generate_thumbnails(params, images):
+    """generate thumbnails for a set of images.
+
+    Returns the results along with the worker pid and the time it spent on
+    the batch to report the workers utilization.
+    """
+    batch_start = time.time()
     num_errors = 0
     log = ''
     # minimal width that make sense to cache.
@@ -26,7 +176,7 @@ def generate_thumbnails(bundle):
 
     start = time.time()
     # According to the doc, cache need to be open in each thread
-    cache = dc(params['cache_file'])
+    cache = get_cache(params['cache_file'])
     cache_timing = {
         'opening': time.time() - start,
         'fetching': 0,
@@ -47,27 +197,35 @@ def generate_thumbnails(bundle):
             requested_extensions.add(f)
         requested_extensions.add(image_info['extension'])
 
-        # loading image in memory
+        # opening the image: PIL reads the file itself and only decodes it
+        # when a resize is needed so cache hits don't load the pixels.
         start = time.time()
         width = image_info['width']
         height = image_info['height']
-        raw_image = read_image_bytes(image_info['disk_path'])
-        img = Image.open(BytesIO(raw_image))
-
-        # loading cache
-        if width >= MIN_CACHED_SIZE:
-            start = time.time()
-            cached_value = cache.get(image_info['hash'])
-            cache_timing['fetching'] += time.time() - start
-
-            # cache miss!
-            if not cached_value:
-                log_row.append('MISS')
-                cached_value = {}
-            else:
-                log_row.append('HIT')
-        else:
-            cached_value = {}
+        img = Image.open(image_info['disk_path'])
+        sizes = [(w, int(height * (float(w) / width)))
+                 for w in params['requested_width_list'] if w <= width]
+        # the JPEG decoder only needs to produce twice the largest requested
+        # width, which is enough for its LANCZOS resize
+        if sizes:
+            largest_width, largest_height = max(sizes)
+            img.draft(img.mode, (largest_width * 2, largest_height * 2))
+
+        # resized bitmaps are shared by all the formats of a width and the
+        # smaller widths are computed from the larger ones when possible
+        plan = params['image_pool'].plan_resizes(sizes)
+        resized = {}
+
+        def get_resized(size):
+            if size not in resized:
+                parent = get_resized(plan[size]) if plan[size] else img
+                resized[size] = parent.resize(size, Image.LANCZOS)
+            return resized[size]
+
+        # each derivative has its own cache entry
+        use_cache = width >= MIN_CACHED_SIZE
+        num_misses = 0
+        if not use_cache:
             log_row.append('SKIP')
 
         # add default images
@@ -81,6 +239,8 @@ def generate_thumbnails(bundle):
             ratio = float(requested_width) / width
             requested_height = int(height * ratio)  # preserve the ratio
 
+            # looking up the cache for all the formats of the width first
+            variants = []
             for extension in requested_extensions:
                 pil_extension_codename, web_extension = normalize_image_extension(extension)  # noqa
 
@@ -100,26 +260,49 @@ def generate_thumbnails(bundle):
                 output_disk_path = image_info['disk_dir'] / output_filename
                 output_web_path = image_info['web_dir'] + output_filename
 
-                # cache lookup
-                cache_secondary_key = "%s-%s" % (pil_extension_codename,
-                                                 requested_width)
-                if cache_secondary_key in cached_value:
-                    img_io = cached_value[cache_secondary_key]
-                else:
-
-                    # generate resized image as it is not in the cache.
-                    resized_img = img.resize((requested_width,
-                                              requested_height), Image.LANCZOS)
-
-                    img_io = convert_image(resized_img,
+                # cache lookup - the cache evicts the least recently used
+                # entries so a hit refreshes the entry without rewriting it
+                cache_key = derivative_key(image_info['hash'],
                                            pil_extension_codename,
-                                           webp_lossless=image_info['lossless']
-                                           )
-
-                    # store in the caches
-                    cached_value[cache_secondary_key] = img_io
-
-                # writing to disk
+                                           requested_width)
+                img_io = None
+                if use_cache:
+                    start = time.time()
+                    cached_value = cache.get(cache_key)
+                    cache_timing['fetching'] += time.time() - start
+                    if cached_value is not None:
+                        img_io = BytesIO(cached_value)
+
+                variants.append([pil_extension_codename, web_extension,
+                                 output_disk_path, output_web_path,
+                                 cache_key, img_io])
+
+            # generate the formats not in the cache from the same resized
+            # image, concurrently if encoding threads are enabled.
+            missing_codecs = [v[0] for v in variants if v[5] is None]
+            if missing_codecs:
+                num_misses += len(missing_codecs)
+                resized_img = get_resized((requested_width,
+                                           requested_height))
+                encoded = encode_variants(resized_img, missing_codecs,
+                                          image_info['lossless'],
+                                          params['encoding_threads'])
+
+            for variant in variants:
+                (pil_extension_codename, web_extension, output_disk_path,
+                 output_web_path, cache_key, img_io) = variant
+                if img_io is None:
+                    img_io = encoded[pil_extension_codename]
+
+                    # only the new derivatives are written to the cache
+                    if use_cache:
+                        start = time.time()
+                        cache.set(cache_key, img_io.getvalue())
+                        cache_timing['writing'] += time.time() - start
+
+                # writing to disk, never through a hardlink made by copy_dir
+                if os.path.lexists(output_disk_path):
+                    os.unlink(output_disk_path)
                 save_image(img_io, output_disk_path)
 
                 # add to resize list
@@ -127,11 +310,8 @@ def generate_thumbnails(bundle):
                 resize_list[web_extension].append(s)
                 log_table.append(log_row)
 
-        # caching results - we write each time to avoid the cache pruning
-        if width > MIN_CACHED_SIZE:
-            start = time.time()
-            cache.set(image_info['hash'], cached_value)
-            cache_timing["writing"] += time.time() - start
+        if use_cache:
+            log_row.insert(1, 'MISS' if num_misses else 'HIT')
 
         if 'opening' in cache_timing:
             log += "<h3>Cache stats</h3>"
@@ -141,6 +321,9 @@ def generate_thumbnails(bundle):
                 ['writing', cache_timing['writing']]
             ], tablefmt='html')
 
+        for resized_img in resized.values():
+            resized_img.close()
+        img.close()
         results.append([image_info['web_path'], resize_list, width,
                         log, num_errors, image_info['hash']])
 
@@ -149,9 +332,7 @@ def generate_thumbnails(bundle):
 
     log += tabulate(log_table, headers=['file', 'process_time'],
                     tablefmt='html')
-    if cache:
-        cache.close()
-    return results
+    return results, os.getpid(), time.time() - batch_start
 
 
 class ResponsiveImages(SitePreparsing):
@@ -170,12 +351,17 @@ class ResponsiveImages(SitePreparsing):
         else:
             requested_format_list = []
 
+        # worker pool shared by the image plugins, published by image_info
+        image_pool = site.plugin_data['image_pool']
+
         params = {
             "site_output_dir": site.config.dir.output,
             "requested_width_list": config.thumbnail_size,
             "requested_format_list": requested_format_list,
             "cache_file": cache_file,
-            "min_image_width": config.cache_min_image_width
+            "min_image_width": config.cache_min_image_width,
+            "encoding_threads": config.encoding_threads or 1,
+            "image_pool": image_pool
         }
 
         resize_images = {}  # store the results
@@ -183,31 +369,68 @@ class ResponsiveImages(SitePreparsing):
         progress_bar = tqdm(total=len(images), unit=' images',
                             desc="Generating responsive_images", leave=False)
 
-        # ensuring that the load will be uniformly split among the threads
-        random.shuffle(images)
-
-        batch_size = 5
-        batches = [images[x: x + batch_size] for x in range(0, len(images),
-                                                            batch_size)]
-
-        bundles = zip(batches, repeat(params))
+        # cost aware scheduling: the most expensive images are dispatched
+        # first so the pool is not waiting on a few large images at the end
+        size_limit = config.cache_size_limit or DEFAULT_CACHE_SIZE_LIMIT
+        cache = get_cache(cache_file, size_limit=size_limit * 1024 * 1024,
+                          eviction_policy='least-recently-used')
+        num_split = migrate_cache(cache)
+        if num_split:
+            log += "Split %s entries of the previous cache format<br>" % (
+                num_split)
+        costs = [estimate_cost(i, params, cache) for i in images]
+        batches = schedule_batches(images, costs, site.config.threads)
+        log += "Scheduling: %s images in %s batches<br>" % (len(images),
+                                                            len(batches))
+
+        generate = partial(generate_thumbnails, params)
         results = []
+        workers = {}  # pid -> [num images, busy time]
+        start = time.time()
 
         # allows non-multithread by setting threads to 1.
         if site.config.threads > 1:
             log += "Using multithreading: %s threads<br>" % (
                 site.config.threads)
 
-            tpool = get_context("fork").Pool(site.config.threads)
-            for data in tpool.imap_unordered(generate_thumbnails, bundles):
-                results.extend(data)
-                progress_bar.update(batch_size)
-            tpool.close()
-            tpool.join()
+            tpool = image_pool.get()
+            memory_budget = config.memory_budget
+            if memory_budget:
+                # the images of a batch are decoded one after the other
+                log += "Memory budget: %s MB<br>" % memory_budget
+                batch_costs = [max(image_pool.decoded_size(i) for i in batch)
+                               for batch in batches]
+                batch_results = image_pool.imap_budget(
+                    generate, batches, batch_costs,
+                    memory_budget * 1024 * 1024, ordered=False)
+            else:
+                batch_results = tpool.imap_unordered(generate, batches)
         else:
-            for bundle in bundles:
-                results.extend(generate_thumbnails(bundle))
-                progress_bar.update(batch_size)
+            batch_results = map(generate, batches)
+
+        for data, pid, busy_time in batch_results:
+            results.extend(data)
+            stats = workers.setdefault(pid, [0, 0])
+            stats[0] += len(data)
+            stats[1] += busy_time
+            progress_bar.update(len(data))
+        progress_bar.close()
+        image_pool.release(site, plugin_name)
+        # evict the least recently used entries if above the size limit
+        cache.cull()
+        log += "Cache size: %s MB / %s MB<br>" % (
+            round(cache.volume() / (1024 * 1024), 1), size_limit)
+
+        # workers utilization
+        elapsed = max(time.time() - start, 0.001)
+        workers_table = []
+        for pid, (num_images, busy_time) in sorted(workers.items()):
+            workers_table.append([pid, num_images, round(busy_time, 2),
+                                  "%s%%" % round(100 * busy_time / elapsed)])
+        log += "<h3>Workers utilization</h3>"
+        log += tabulate(workers_table, headers=['worker', 'images',
+                                                'busy time', 'utilization'],
+                        tablefmt='html')
 
         for result in results:
             # be extra sure that windows path don't messup the thing
@@ -1,9 +1,265 @@
+from itertools import islice
+from multiprocessing import get_context
+from pathlib import Path
+
 import gensim
-from gensim import corpora, models, similarities
+import numpy as np
+from diskcache import Cache as dc
+from gensim import corpora, matutils, models, similarities
 
 from sitefab.plugins import SiteProcessor
 from sitefab.SiteFab import SiteFab
 from sitefab import utils
+from sitefab.utils import hexdigest
+
+# bumped each time the layout of the cached model changes
+MODEL_VERSION = 2
+
+# fraction of the posts added, changed or removed since the last training
+# above which the model is trained again from scratch
+DEFAULT_RETRAIN_THRESHOLD = 0.2
+
+# the blocks backend scores BLOCK_ROWS posts against BLOCK_COLUMNS posts at
+# a time: 4 MB of float32 scores, large enough for efficient products
+BLOCK_ROWS = 1024
+BLOCK_COLUMNS = 1024
+
+# posts tokenized between two writes of their tokens in the cache
+TOKENS_BATCH_SIZE = 256
+
+
+def tokenize(txt):
+    "Split a post content in the tokens used by the model."
+    return gensim.utils.simple_preprocess(txt, deacc=True, min_len=3,
+                                          max_len=15)
+
+
+def nlp_tokens(post):
+    "Use the key terms found by the sitefab NLP analysis as the post tokens."
+    return [term.lower() for term, _ in post.nlp.terms]
+
+
+def iter_tokens(posts, cache, num_threads):
+    """Tokenize the content of the posts one post at a time.
+
+    Tokens are cached by post content hash so training again only tokenizes
+    the posts that changed. The others are tokenized by a pool of processes
+    and written in the cache by batches.
+
+    Args:
+        posts (dict): content hash -> post.
+        cache (Cache): plugin cache.
+        num_threads (int): number of processes.
+
+    Yields:
+        tuple: (content hash, tokens) of each post.
+    """
+    misses = []
+    for h in posts:
+        tokens = cache.get("tokens:%s" % h)
+        if tokens is None:
+            misses.append(h)
+        else:
+            yield h, tokens
+
+    texts = (posts[h].md for h in misses)
+    # allows non-multithread by setting threads to 1.
+    pool = None
+    if num_threads > 1 and len(misses) > 1:
+        pool = get_context("fork").Pool(num_threads)
+        results = pool.imap(tokenize, texts,
+                            chunksize=max(1, len(misses) // (num_threads * 4)))
+    else:
+        results = map(tokenize, texts)
+
+    try:
+        results = zip(misses, results)
+        while True:
+            batch = list(islice(results, TOKENS_BATCH_SIZE))
+            if not batch:
+                break
+            # one short transaction per batch, never held while the caller
+            # consumes the tokens
+            with cache.transact():
+                for h, tokens in batch:
+                    cache.set("tokens:%s" % h, tokens)
+            yield from batch
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def train_model(docs, num_topics, corpus_file=None):
+    """Train the dictionary, tf-idf and LSI models from scratch.
+
+    With a corpus_file the bag of words are written to a MmCorpus file as
+    the posts are tokenized and the tf-idf and LSI models are trained by
+    streaming it from the disk, so the tokens and bag of words of all the
+    posts are never in memory at once.
+
+    Args:
+        docs (iterable): (post content hash, tokens) of each post.
+        num_topics (int): number of LSI topics.
+        corpus_file (Path, optional): MmCorpus file storing the bag of words.
+
+    Returns:
+        dict: the model, with the bag of words of each post by hash or
+        their row in the corpus_file.
+    """
+    dictionary = corpora.Dictionary()
+    rows = {}
+
+    def doc2bows():
+        for h, doc in docs:
+            rows[h] = len(rows)
+            yield dictionary.doc2bow(doc, allow_update=True)
+
+    if corpus_file:
+        corpora.MmCorpus.serialize(str(corpus_file), doc2bows())
+        corpus = corpora.MmCorpus(str(corpus_file))
+        bows = {}
+    else:
+        corpus = list(doc2bows())
+        bows = dict(zip(rows, corpus))
+        rows = {}
+    tfidf = models.tfidfmodel.TfidfModel(corpus=corpus)
+    topic_model = models.LsiModel(tfidf[corpus], id2word=dictionary,
+                                  num_topics=num_topics)
+    return {
+        "version": MODEL_VERSION,
+        "dictionary": dictionary,
+        "tfidf": tfidf,
+        "topic_model": topic_model,
+        "bows": bows,
+        "corpus_file": str(corpus_file) if corpus_file else None,
+        "rows": rows,  # row of each post in the corpus_file
+        "num_trained": len(bows) + len(rows),  # posts at the last training
+        "num_changes": 0  # posts folded in or removed since
+    }
+
+
+def post_bows(model, hashes):
+    """Bag of words of the posts, read from the corpus_file of the model
+    one post at a time for the posts trained in streaming mode.
+
+    Args:
+        model (dict): model returned by train_model().
+        hashes (list): content hash of the posts.
+
+    Yields:
+        list: bag of words of each post.
+    """
+    corpus = None
+    if model['rows']:
+        corpus = corpora.MmCorpus(model['corpus_file'])
+    for h in hashes:
+        if h in model['bows']:
+            yield model['bows'][h]
+        else:
+            yield corpus[model['rows'][h]]
+
+
+def update_model(model, docs, removed):
+    """Fold new posts in the model and forget the removed ones.
+
+    The new posts are projected with the existing dictionary and tf-idf
+    weights, words the dictionary doesn't know are ignored, and added to
+    the LSI decomposition with LsiModel.add_documents(). Removed posts can't
+    be taken out of the decomposition, they only count toward the drift.
+
+    Args:
+        model (dict): model returned by train_model().
+        docs (dict): content hash -> tokens of the new posts.
+        removed (set): content hash of the posts that are gone.
+    """
+    bows = {h: model['dictionary'].doc2bow(doc) for h, doc in docs.items()}
+    if bows:
+        model['topic_model'].add_documents(
+            model['tfidf'][list(bows.values())])
+    model['bows'].update(bows)
+    for h in removed:
+        model['bows'].pop(h, None)
+        model['rows'].pop(h, None)
+    model['num_changes'] += len(bows) + len(removed)
+
+
+def lsi_vectors(vectors, num_docs, num_topics, dtype='float32', path=None):
+    """Store the LSI vectors of the posts in a dense array, normalized to
+    unit length so their dot product is their cosine similarity.
+
+    Args:
+        vectors (iterable): sparse LSI vector of each post.
+        num_docs (int): number of posts.
+        num_topics (int): number of LSI topics.
+        dtype (str, optional): array type. Defaults to float32.
+        path (Path, optional): memory map the array to this .npy file
+        instead of keeping it in memory.
+
+    Returns:
+        ndarray: num_docs x num_topics array.
+    """
+    shape = (num_docs, num_topics)
+    if path:
+        array = np.lib.format.open_memmap(str(path), mode='w+', dtype=dtype,
+                                          shape=shape)
+    else:
+        array = np.zeros(shape, dtype=dtype)
+    for row, vector in zip(array, vectors):
+        if vector:
+            topics, values = zip(*vector)
+            row[list(topics)] = values
+            norm = np.linalg.norm(row)
+            if norm:
+                row /= norm
+    return array
+
+
+def top_k_similar(vectors, k):
+    """Find the k most similar posts of each post without computing the full
+    similarity matrix.
+
+    The similarities are computed by blocks of BLOCK_ROWS x BLOCK_COLUMNS
+    posts. For each block the k best of each row are selected with
+    argpartition and merged with the best of the previous blocks, so memory
+    only depends on the block size and k.
+
+    Args:
+        vectors (ndarray): unit length vectors returned by lsi_vectors().
+        k (int): number of similar posts.
+
+    Yields:
+        list: (post index, score) of the k most similar posts, the post
+        itself excluded, by decreasing score.
+    """
+    num_docs = len(vectors)
+    k = max(min(k, num_docs - 1), 0)
+    for start in range(0, num_docs, BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + BLOCK_ROWS])
+        rows = np.arange(len(block))
+        best = np.zeros((len(block), 0), dtype=int)
+        best_scores = np.zeros((len(block), 0), dtype=vectors.dtype)
+        for col in range(0, num_docs, BLOCK_COLUMNS):
+            scores = block @ np.asarray(vectors[col:col + BLOCK_COLUMNS]).T
+            # a post is not similar to itself
+            own = (start + rows >= col) & (start + rows < col + len(scores[0]))  # noqa
+            scores[rows[own], start + rows[own] - col] = -np.inf
+            num_best = min(k, scores.shape[1])
+            candidates = np.argpartition(scores, -num_best, axis=1)
+            candidates = candidates[:, scores.shape[1] - num_best:]
+            best = np.hstack([best, candidates + col])
+            best_scores = np.hstack([
+                best_scores, np.take_along_axis(scores, candidates, axis=1)])
+            if best.shape[1] > k:
+                keep = np.argpartition(best_scores, -k, axis=1)
+                keep = keep[:, best.shape[1] - k:]
+                best = np.take_along_axis(best, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best = np.take_along_axis(best, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        for idxs, sims in zip(best, best_scores):
+            yield list(zip(idxs.tolist(), sims))
 
 
 class RelatedPosts(SiteProcessor):
@@ -11,37 +267,114 @@ class RelatedPosts(SiteProcessor):
     VALID_FORMAT = ['ScholarlyArticle', 'BlogPosting', 'PublicationEvent']
 
     def process(self, unused, site, config):
+        plugin_name = "related_posts"
+        cache_file = site.config.root_dir / site.config.dir.cache / plugin_name
 
         try:
             num_related_posts = config.num_related_posts
-            # Tokenize
-            docs = []
+            retrain_threshold = config.retrain_threshold
+            if retrain_threshold is None:
+                retrain_threshold = DEFAULT_RETRAIN_THRESHOLD
+            tokenizer = config.tokenizer or 'markdown'
+            streaming = bool(config.streaming)
+
             valid_posts = [] #exclude pages that are not posts
+            hashes = []  # content hash of each valid post
             for post in site.posts:
                 if post.meta.microdata_type not in RelatedPosts.VALID_FORMAT:
                     continue
-                txt = post.md
-                docs.append(gensim.utils.simple_preprocess(txt, deacc=True, min_len=3, max_len=15))
                 valid_posts.append(post)
+                content = post.md
+                if tokenizer == 'nlp':
+                    # key terms also depend on the title, tags...
+                    content = "\n".join(nlp_tokens(post))
+                hashes.append(hexdigest(content.encode('utf-8')))
                 # Fixme stemming
 
-            # build model
-            dictionary = corpora.Dictionary(docs)
-            corpus = [dictionary.doc2bow(doc) for doc in docs]
-            tfidf = models.tfidfmodel.TfidfModel(corpus=corpus)
-            # Fixme: get correct number of topics
-            num_topics = len(site.posts) / 5  # use the number of post as proxy for number of topics
-            topic_model = models.LsiModel(tfidf[corpus], id2word=dictionary, num_topics=num_topics)
-            index = similarities.MatrixSimilarity(topic_model[tfidf[corpus]], num_best=num_related_posts + 1) #+1 because the best one is itself
+            # the model of the previous build is reused when only a few
+            # posts changed since it was trained
+            cache = dc(cache_file)
+            model = cache.get('model')
+            if (model and model['version'] == MODEL_VERSION
+                    and model.get('tokenizer', 'markdown') == tokenizer
+                    and (not model['rows']
+                         or Path(model['corpus_file']).exists())):
+                known = set(model['bows']) | set(model['rows'])
+                new = set(hashes) - known
+                removed = known - set(hashes)
+                drift = (model['num_changes'] + len(new) + len(removed)) / float(max(model['num_trained'], 1))  # noqa
+            else:
+                model = None
+
+            retrain = not model or drift > retrain_threshold
+            posts = {}  # posts to tokenize by content hash
+            for post, h in zip(valid_posts, hashes):
+                if retrain or h in new:
+                    posts[h] = post
+
+            # Tokenize, one post at a time as the model consumes them
+            if tokenizer == 'nlp':
+                docs = ((h, nlp_tokens(post)) for h, post in posts.items())
+            else:
+                docs = iter_tokens(posts, cache, site.config.threads)
+
+            if retrain:
+                # Fixme: get correct number of topics
+                num_topics = len(site.posts) / 5  # use the number of post as proxy for number of topics
+                corpus_file = None
+                if streaming:
+                    corpus_file = cache_file.parent / ("%s_corpus.mm" % plugin_name)  # noqa
+                    # the cached model may point to the file overwritten
+                    cache.delete('model')
+                model = train_model(docs, num_topics, corpus_file)
+                model['tokenizer'] = tokenizer
+                cache.set('model', model)
+                log = "Model trained on %s posts<br>" % model['num_trained']
+            else:
+                docs = dict(docs)
+                if docs or removed:
+                    update_model(model, docs, removed)
+                    cache.set('model', model)
+                log = "Model updated: %s new posts, %s removed, drift %s/%s<br>" % (  # noqa
+                    len(docs), len(removed), round(drift, 3),
+                    retrain_threshold)
+            cache.close()
+
+            tfidf = model['tfidf']
+            topic_model = model['topic_model']
+            corpus = post_bows(model, hashes)
+            if not streaming:
+                corpus = list(corpus)
+            vectors = topic_model[tfidf[corpus]]
+            if config.similarity == 'blocks' or streaming:
+                # the posts are streamed through tf-idf and LSI, only their
+                # dense LSI vectors are kept
+                path = None
+                if config.similarity_mmap:
+                    path = cache_file.parent / ("%s_vectors.npy" % plugin_name)  # noqa
+                vectors = lsi_vectors(vectors, len(hashes),
+                                      topic_model.num_topics,
+                                      config.similarity_dtype or 'float32',
+                                      path)
+            if config.similarity == 'blocks':
+                # top k search by blocks, the similarity matrix is never
+                # entirely in memory
+                index = top_k_similar(vectors, num_related_posts)
+            else:
+                if streaming:
+                    vectors = matutils.Dense2Corpus(vectors,
+                                                    documents_columns=False)
+                index = similarities.MatrixSimilarity(vectors, num_best=num_related_posts + 1, num_features=topic_model.num_topics) #+1 because the best one is itself
+                index = (sims[1:] for sims in index) #1: > first one is the article itself
 
             # find simlar posts and store them
-            log_details = ""
+            log_details = log
             for post, sims in zip(valid_posts, index):
                 if post.meta.microdata_type not in RelatedPosts.VALID_FORMAT:
                     continue
                 post.meta.related_posts = []
                 log_details += '<div class="subsection"><h3>%s</h3>Related posts:<ol>' % (post.meta.title)
-                for idx, score in sims[1:]: #1: > first one is the article itself
+                for idx, score in sims:
                     p = valid_posts[idx]
                     o = utils.create_objdict()
                     o.meta = p.meta
@@ -53,4 +386,3 @@ class RelatedPosts(SiteProcessor):
             return (SiteFab.OK, "Related posts via LSI", log_details)
         except Exception as e:
             return (SiteFab.ERROR, "Related posts via LSI", e)
-